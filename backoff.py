@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+logger = logging.getLogger('qutefox')
+
+# retries of a request answered 503 (server busy) or, by the storage server,
+# 409 (concurrent write by another client)
+MAX_RETRIES = 4
+# seconds before the first retry, doubled on each one and jittered
+BASE_DELAY = 1
+MAX_DELAY = 30
+# a longer wait asked for by the server is not slept through: the request
+# fails and the next runs are skipped until it is over
+MAX_RETRY_WAIT = 60
+
+
+def header_seconds(value):
+    """
+    Parse the value of a Retry-After or X-Weave-Backoff header, a number
+    of seconds or an HTTP date, into seconds from now.
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        logger.warning(f'Cannot parse backoff header: {value}')
+        return None
+
+
+class BackoffWindow():
+    """
+    Time until which the server asked us not to sync, kept in a file so
+    that later runs, from cron or the daemon, honor it as well.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            return json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError:
+            logger.error('Backoff file corrupt, ignoring it.')
+            return {}
+
+    def remaining(self):
+        """Return the seconds left in the window, 0 if not in effect."""
+        return max(self._load().get('until', 0) - time.time(), 0)
+
+    def reason(self):
+        return self._load().get('reason')
+
+    def extend(self, seconds, reason):
+        """Make the window last at least `seconds` from now."""
+        until = time.time() + seconds
+        with self._lock:
+            if self._load().get('until', 0) >= until:
+                return
+            logger.warning(f'Backing off for {seconds:.0f}s: {reason}')
+            tmp_path = self.path.with_name(f'.{self.path.name}.{os.getpid()}')
+            tmp_path.write_text(json.dumps({'until': until,
+                                            'reason': reason}))
+            os.replace(tmp_path, self.path)
+
+
+class RequestScheduler():
+    """
+    Decide whether and when a request is retried, following the backoff
+    headers of the Sync, token and FxA servers. X-Weave-Backoff and
+    X-Backoff, which may come with any response, extend `window`.
+    """
+
+    def __init__(self, window=None, max_retries=MAX_RETRIES):
+        self.window = window
+        self.max_retries = max_retries
+
+    def observe(self, response):
+        """Record the backoff asked for by `response`, if any."""
+        backoff = header_seconds(
+            response.headers.get('X-Weave-Backoff')
+            or response.headers.get('X-Backoff'))
+        if backoff and self.window is not None:
+            self.window.extend(backoff, f'{response.status_code} from '
+                               f'{response.url.split("?")[0]}')
+        return backoff
+
+    def retry_delay(self, response, attempt):
+        """
+        Return the seconds to wait before retrying the request that got
+        `response` on its `attempt`th retry, or None if it must not be.
+        """
+        backoff = self.observe(response)
+        status = response.status_code
+        # FxA uses 409 for conflicts that a retry does not solve; only the
+        # storage server, which timestamps its responses, means "try again"
+        if status != 503 and not (
+                status == 409 and 'X-Weave-Timestamp' in response.headers):
+            return None
+        wait = header_seconds(response.headers.get('Retry-After'))
+        if status == 503 and backoff:
+            wait = max(wait or 0, backoff)
+        if attempt >= self.max_retries or (wait or 0) > MAX_RETRY_WAIT:
+            if wait and self.window is not None:
+                self.window.extend(wait, f'{status} from '
+                                   f'{response.url.split("?")[0]}')
+            return None
+        delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+        return max(delay, wait or 0)
@@ -0,0 +1,203 @@
+import json
+import logging
+import math
+
+import requests
+
+logger = logging.getLogger('qutefox')
+
+# limits used when the server does not provide info/configuration, see
+# https://mozilla-services.readthedocs.io/en/latest/storage/apis-1.5.html
+DEFAULT_CONFIGURATION = {
+    'max_post_records': 100,
+    'max_post_bytes': 2 * 1024 * 1024,
+    'max_total_records': 10000,
+    'max_total_bytes': 100 * 1024 * 1024,
+    'max_request_bytes': 2 * 1024 * 1024 + 4096,
+    'max_record_payload_bytes': 256 * 1024,
+}
+# when the storage quota left is below this many POSTs, batches are made
+# smaller so that they are committed before it runs out
+QUOTA_LOW_POSTS = 4
+
+
+class PreconditionFailed(Exception):
+    """The collection was modified on the server by another client."""
+
+
+def encrypted_size(record):
+    """
+    Estimate the size in bytes of the payload of `record` once encrypted,
+    i.e. the JSON of {"ciphertext": ..., "IV": ..., "hmac": ...}.
+    """
+    plaintext = len(json.dumps(record).encode('utf-8'))
+    # AES-CBC with PKCS#7 padding, then base64
+    ciphertext = 4 * math.ceil((plaintext // 16 + 1) * 16 / 3)
+    # IV (24 base64 chars), hmac (64 hex chars) and the JSON around them
+    return ciphertext + 24 + 64 + 44
+
+
+class BatchUploader():
+    """
+    Upload records to a collection in as few POSTs as the server limits
+    allow, inside a single atomic batch whenever possible.
+
+    Records are given one at a time with add(); at most one POST worth of
+    records is kept in memory. commit() must be called at the end.
+
+    If `encrypt` is given, it is called on every record to obtain the
+    encrypted BSO; otherwise records are encrypted by syncclient and their
+    size can only be estimated.
+
+    If `unmodified_since` is given, the server rejects the upload with
+    PreconditionFailed when the collection changed after that time.
+
+    POSTs rejected as too large (413) are split in two, and the limits
+    lowered for the rest of the upload; they are lowered as well when
+    X-Weave-Quota-Remaining runs low.
+    """
+
+    def __init__(self, sync_client, collection, configuration=None,
+                 encrypt=None, unmodified_since=None):
+        self.sync_client = sync_client
+        self.collection = collection
+        self.config = dict(DEFAULT_CONFIGURATION, **(configuration or {}))
+        self.encrypt = encrypt
+        self.unmodified_since = unmodified_since
+        self.chunk = []
+        self.chunk_bytes = 0
+        self.chunk_request_bytes = 0
+        self.pending = None
+        self.batch_id = None
+        self.batch_records = 0
+        self.batch_bytes = 0
+        self.chunks = []
+        self.success = []
+        self.failed = {}
+        self.modified = None
+
+    def add(self, record):
+        if self.encrypt is not None:
+            record = self.encrypt(record)
+            size = len(record['payload'])
+        else:
+            size = encrypted_size(record)
+        if size > self.config['max_record_payload_bytes']:
+            logger.error(f'Record {record["id"]} too large, skipping')
+            self.failed[record['id']] = ['record too large']
+            return
+        # the whole BSO also carries the id and JSON-escaped payload
+        request_size = size + len(record['id']) + size // 8 + 32
+        if self.chunk and (
+                len(self.chunk) >= self.config['max_post_records']
+                or self.chunk_bytes + size > self.config['max_post_bytes']
+                or self.chunk_request_bytes + request_size
+                > self.config['max_request_bytes']):
+            self._next_chunk()
+        self.chunk.append(record)
+        self.chunk_bytes += size
+        self.chunk_request_bytes += request_size
+
+    def commit(self):
+        """
+        Send the remaining records and commit the batch. Return a dict with
+        the ids of the records that were stored ('success') and of those
+        that were not ('failed'), like a single POST response.
+        """
+        if self.chunk:
+            self._next_chunk()
+        if self.pending is not None:
+            self._post(self.pending, commit=True)
+            self.pending = None
+        return {'modified': self.modified,
+                'success': self.success,
+                'failed': self.failed}
+
+    def _next_chunk(self):
+        # keep one chunk back so that the last POST can carry commit=true
+        if self.pending is not None:
+            pending, bytes_ = self.pending
+            full = (self.batch_records + len(pending) + len(self.chunk)
+                    > self.config['max_total_records']
+                    or self.batch_bytes + bytes_ + self.chunk_bytes
+                    > self.config['max_total_bytes'])
+            if full:
+                logger.warning('Batch limits reached, committing early')
+            self._post(self.pending, commit=full)
+        self.pending = (self.chunk, self.chunk_bytes)
+        self.chunk = []
+        self.chunk_bytes = 0
+        self.chunk_request_bytes = 0
+
+    def _post(self, pending, commit=False):
+        records, bytes_ = pending
+        params = {'batch': self.batch_id or 'true'}
+        if commit:
+            params['commit'] = 'true'
+        headers = {}
+        if self.unmodified_since is not None:
+            headers['X-If-Unmodified-Since'] = str(self.unmodified_since)
+        try:
+            response = self.sync_client.post_records(
+                self.collection, records, params=params, headers=headers,
+                encrypt=self.encrypt is None)
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code if e.response is not None \
+                else None
+            if status == 412:
+                raise PreconditionFailed(
+                    f'{self.collection} was modified by another client')
+            if status == 413 and len(records) > 1:
+                half = len(records) // 2
+                logger.warning(f'POST of {len(records)} records too large, '
+                               'splitting it')
+                self._shrink(max_post_records=half,
+                             max_post_bytes=bytes_ // 2)
+                self._post((records[:half], bytes_ // 2))
+                self._post((records[half:], bytes_ - bytes_ // 2),
+                           commit=commit)
+                return
+            raise
+        self._check_quota(self.sync_client.raw_resp.headers)
+        if isinstance(response, (str, bytes)):
+            response = json.loads(response)
+        success = response.get('success', [])
+        failed = response.get('failed', {})
+        # ids in neither list must be treated as failed
+        missing = {r['id'] for r in records} - set(success) - set(failed)
+        failed.update({i: ['unknown'] for i in missing})
+        self.success += success
+        self.failed.update(failed)
+        self.chunks.append({'records': len(records),
+                            'success': len(success),
+                            'failed': len(failed)})
+        logger.info(f'Uploaded chunk {len(self.chunks)} of {self.collection}'
+                    f': {len(success)} stored, {len(failed)} failed')
+        if commit or response.get('batch') is None:
+            # committed, or the server does not support batches
+            self.modified = response.get('modified', self.modified)
+            if self.unmodified_since is not None:
+                self.unmodified_since = self.modified
+            self.batch_id = None
+            self.batch_records = 0
+            self.batch_bytes = 0
+        else:
+            self.batch_id = response['batch']
+            self.batch_records += len(records)
+            self.batch_bytes += bytes_
+
+    def _shrink(self, **limits):
+        for key, value in limits.items():
+            if value < self.config[key]:
+                self.config[key] = max(value, 1)
+
+    def _check_quota(self, headers):
+        quota = headers.get('X-Weave-Quota-Remaining')
+        if quota is None:
+            return
+        # in kilobytes
+        remaining = int(float(quota) * 1024)
+        if remaining < self.config['max_post_bytes'] * QUOTA_LOW_POSTS:
+            logger.warning(f'Only {quota} KB of storage quota left')
+            self._shrink(max_post_bytes=remaining // QUOTA_LOW_POSTS,
+                         max_total_bytes=remaining // 2)
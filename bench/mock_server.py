@@ -0,0 +1,259 @@
+import copy
+import gzip
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CONFIGURATION = {
+    'max_post_records': 100,
+    'max_post_bytes': 2 * 1024 * 1024,
+    'max_total_records': 10000,
+    'max_total_bytes': 100 * 1024 * 1024,
+    'max_request_bytes': 2 * 1024 * 1024 + 4096,
+    'max_record_payload_bytes': 256 * 1024,
+}
+UID = '1'
+GZIP_MIN_SIZE = 1024
+
+
+class MockSyncServer():
+    """
+    Local mock of the Sync 1.5 storage and token servers, good enough for
+    syncclient and QuteFoxClient. Hawk signatures are not checked.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.collections = {}
+        self.modified = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.mock = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def api_endpoint(self):
+        return f'{self.url}/1.5/{UID}'
+
+    def credentials(self):
+        return {'uid': UID, 'api_endpoint': self.api_endpoint,
+                'hashalg': 'sha256', 'id': 'bench', 'key': 'bench'}
+
+    def reset_stats(self):
+        self.stats = {'requests': 0, 'bytes_sent': 0, 'bytes_received': 0}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def snapshot(self):
+        with self.lock:
+            return copy.deepcopy((self.collections, self.modified))
+
+    def restore(self, snapshot):
+        """Reset the stored collections to a previous snapshot()."""
+        with self.lock:
+            self.collections, self.modified = copy.deepcopy(snapshot)
+            self.batches = {}
+
+    def _timestamp(self):
+        now = round(time.time(), 2)
+        last = max(self.modified.values(), default=0)
+        return max(now, round(last + 0.01, 2))
+
+    def put(self, collection, bsos, modified=None):
+        """Store BSOs (dicts with 'id' and 'payload') in one write."""
+        with self.lock:
+            modified = modified or self._timestamp()
+            records = self.collections.setdefault(collection, {})
+            for bso in bsos:
+                record = records.get(bso['id'], {})
+                record.update(bso)
+                record['modified'] = modified
+                records[bso['id']] = record
+            self.modified[collection] = modified
+        return modified
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, which stalls keep-alive
+    # connections on delayed ACKs unless Nagle's algorithm is off
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def _reply(self, status, body=None, headers=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        # like the real servers, compress large bodies when asked to
+        if len(data) > GZIP_MIN_SIZE and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data, compresslevel=6)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        for key, val in (headers or {}).items():
+            self.send_header(key, str(val))
+        self.end_headers()
+        self.wfile.write(data)
+        with self.mock.lock:
+            self.mock.stats['bytes_sent'] += len(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+        with self.mock.lock:
+            self.mock.stats['bytes_received'] += length
+        return json.loads(data) if data else None
+
+    def _route(self):
+        with self.mock.lock:
+            self.mock.stats['requests'] += 1
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        parts = [p for p in url.path.split('/') if p]
+        return parts, query
+
+    def _last_modified(self, collection=None):
+        if collection is None:
+            return max(self.mock.modified.values(), default=0)
+        return self.mock.modified.get(collection, 0)
+
+    def _preconditions(self, modified):
+        since = self.headers.get('X-If-Modified-Since')
+        if since is not None and modified <= float(since):
+            self._reply(304, headers={'X-Last-Modified': modified})
+            return False
+        unmodified = self.headers.get('X-If-Unmodified-Since')
+        if unmodified is not None and modified > float(unmodified):
+            self._reply(412, headers={'X-Last-Modified': modified})
+            return False
+        return True
+
+    def do_GET(self):
+        parts, query = self._route()
+        if parts[:2] == ['1.0', 'sync']:
+            self._reply(200, dict(self.mock.credentials(), duration=3600))
+            return
+        if parts[:2] != ['1.5', UID]:
+            self._reply(404)
+            return
+        parts = parts[2:]
+        if parts == ['info', 'collections']:
+            modified = self._last_modified()
+            if self._preconditions(modified):
+                self._reply(200, self.mock.modified,
+                            {'X-Last-Modified': modified})
+        elif parts == ['info', 'configuration']:
+            self._reply(200, CONFIGURATION)
+        elif parts[0] == 'storage' and len(parts) == 3:
+            record = self.mock.collections.get(parts[1], {}).get(parts[2])
+            if record is None:
+                self._reply(404)
+            else:
+                self._reply(200, record,
+                            {'X-Last-Modified': record['modified']})
+        elif parts[0] == 'storage' and len(parts) == 2:
+            self._get_collection(parts[1], query)
+        else:
+            self._reply(404)
+
+    def _get_collection(self, collection, query):
+        modified = self._last_modified(collection)
+        if not self._preconditions(modified):
+            return
+        with self.mock.lock:
+            records = list(self.mock.collections.get(collection,
+                                                     {}).values())
+        if 'ids' in query:
+            ids = set(query['ids'].split(','))
+            records = [r for r in records if r['id'] in ids]
+        if 'newer' in query:
+            records = [r for r in records
+                       if r['modified'] > float(query['newer'])]
+        sort = query.get('sort', 'newest')
+        if sort == 'index':
+            records.sort(key=lambda r: r.get('sortindex', 0), reverse=True)
+        else:
+            records.sort(key=lambda r: r['modified'],
+                         reverse=sort != 'oldest')
+        headers = {'X-Last-Modified': modified,
+                   'X-Weave-Records': len(records)}
+        offset = int(query.get('offset', 0))
+        if 'limit' in query:
+            limit = int(query['limit'])
+            if offset + limit < len(records):
+                headers['X-Weave-Next-Offset'] = offset + limit
+            records = records[offset:offset + limit]
+        if 'full' not in query:
+            records = [r['id'] for r in records]
+        self._reply(200, records, headers)
+
+    def do_POST(self):
+        parts, query = self._route()
+        if parts[:3] != ['1.5', UID, 'storage'] or len(parts) != 4:
+            self._reply(404)
+            return
+        collection = parts[3]
+        bsos = self._body()
+        if not self._preconditions(self._last_modified(collection)):
+            return
+        if len(bsos) > CONFIGURATION['max_post_records']:
+            self._reply(413)
+            return
+        batch = query.get('batch')
+        if batch is None:
+            modified = self.mock.put(collection, bsos)
+            self._reply(200, {'modified': modified,
+                              'success': [b['id'] for b in bsos],
+                              'failed': {}},
+                        {'X-Last-Modified': modified})
+            return
+        with self.mock.lock:
+            if batch == 'true':
+                batch = uuid.uuid4().hex
+                self.mock.batches[batch] = []
+            pending = self.mock.batches.get(batch)
+        if pending is None:
+            self._reply(400, 'Invalid batch')
+            return
+        pending.extend(bsos)
+        response = {'success': [b['id'] for b in bsos], 'failed': {}}
+        if query.get('commit') == 'true':
+            with self.mock.lock:
+                del self.mock.batches[batch]
+            modified = self.mock.put(collection, pending)
+            response['modified'] = modified
+            self._reply(200, response, {'X-Last-Modified': modified})
+        else:
+            response['batch'] = batch
+            self._reply(202, response)
+
+    def do_PUT(self):
+        parts, query = self._route()
+        if parts[:3] != ['1.5', UID, 'storage'] or len(parts) != 5:
+            self._reply(404)
+            return
+        bso = dict(self._body(), id=parts[4])
+        modified = self.mock.put(parts[3], [bso])
+        self._reply(200, modified, {'X-Last-Modified': modified})
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import random
+import sqlite3
+from pathlib import Path
+
+import yaml
+
+# first visit of the synthetic profiles, 2021-01-01
+START_TIME = 1609459200
+
+
+def _url(i):
+    return f'https://example{i % 997}.com/page/{i}'
+
+
+def _guid(kind, i):
+    return hashlib.sha1(f'{kind}{i}'.encode('utf-8')).hexdigest()[:12]
+
+
+def make_qute_history(path, visits, urls=None, seed=0):
+    """
+    Create a qutebrowser history.sqlite with `visits` visits spread over
+    `urls` distinct urls (a tenth of the visits by default).
+    """
+    rng = random.Random(seed)
+    urls = urls or max(visits // 10, 1)
+    db = sqlite3.connect(path)
+    with db:
+        db.execute('CREATE TABLE IF NOT EXISTS History (url TEXT NOT NULL, '
+                   'title TEXT NOT NULL, atime INTEGER NOT NULL, '
+                   'redirect BOOLEAN NOT NULL);')
+        db.execute('CREATE INDEX IF NOT EXISTS AtimeIndex '
+                   'ON History (atime);')
+        db.execute('CREATE TABLE IF NOT EXISTS CompletionHistory '
+                   '(url TEXT PRIMARY KEY, title TEXT NOT NULL, '
+                   'last_atime INTEGER NOT NULL);')
+        db.executemany(
+            'INSERT INTO History VALUES (?, ?, ?, ?);',
+            ((_url(rng.randrange(urls)), f'Page {i}', START_TIME + i * 60,
+              int(rng.random() < 0.05)) for i in range(visits)))
+        db.execute('INSERT OR REPLACE INTO CompletionHistory '
+                   'SELECT url, title, max(atime) FROM History '
+                   'WHERE redirect = 0 GROUP BY url;')
+    db.close()
+
+
+def make_qute_bookmarks(path, count):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        for i in range(count):
+            f.write(f'https://bookmark{i}.example.org/ Bookmark number {i}\n')
+
+
+def make_qute_session(path, tabs, windows=1):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    session = {'windows': []}
+    per_window = max(tabs // windows, 1)
+    for w in range(windows):
+        tree = {0: {'children': list(range(1, per_window + 1)),
+                    'collapsed': False, 'tab': {}}}
+        for i in range(1, per_window + 1):
+            tree[i] = {'children': [], 'collapsed': False, 'tab': {
+                'history': [{
+                    'active': True,
+                    'last_visited': f'2021-01-01T00:{i % 60:02}:00',
+                    'pinned': False,
+                    'scroll-pos': {'x': 0, 'y': 0},
+                    'title': f'Tab {w}-{i}',
+                    'url': _url(w * per_window + i),
+                    'zoom': 1.0,
+                }]}}
+        session['windows'].append({'active': w == 0, 'geometry': None,
+                                   'tree': tree})
+    with open(path, 'w') as f:
+        yaml.dump(session, f, default_flow_style=False)
+
+
+def make_ff_history(urls, visits_per_url=5, offset=0):
+    """Yield Firefox history payloads, half overlapping the qute profile."""
+    for i in range(offset, offset + urls):
+        yield {
+            'id': _guid('history', i),
+            'histUri': _url(i),
+            'title': f'Firefox page {i}',
+            'visits': [{'date': (START_TIME + i * 60 + v * 3600) * 10**6,
+                        'type': 1} for v in range(visits_per_url)],
+        }
+
+
+def make_ff_bookmarks(count, folder_id, folder_title='bench',
+                      parent='menu', per_folder=500):
+    """
+    Return the payloads of a bookmark folder holding `count` bookmarks,
+    split in subfolders of `per_folder`.
+    """
+    records = []
+    subfolders = []
+    for f in range(0, count, per_folder):
+        sub_id = _guid('folder', f)
+        children = []
+        for i in range(f, min(f + per_folder, count)):
+            bookmark_id = _guid('bookmark', i)
+            children.append(bookmark_id)
+            records.append({
+                'id': bookmark_id, 'type': 'bookmark',
+                'parentid': sub_id, 'parentName': f'Sub {f}',
+                'title': f'Firefox bookmark {i}',
+                'bmkUri': f'https://ffbookmark{i}.example.org/'})
+        records.append({'id': sub_id, 'type': 'folder',
+                        'parentid': folder_id, 'parentName': folder_title,
+                        'title': f'Sub {f}', 'children': children})
+        subfolders.append(sub_id)
+    records.append({'id': folder_id, 'type': 'folder', 'parentid': parent,
+                    'parentName': parent, 'title': folder_title,
+                    'children': subfolders})
+    return records
+
+
+def make_ff_tabs(clients, tabs):
+    return [{
+        'id': _guid('client', c),
+        'clientName': f'firefox-{c}',
+        'tabs': [{'title': f'Remote tab {c}-{i}',
+                  'urlHistory': [_url(c * tabs + i)],
+                  'icon': None, 'lastUsed': START_TIME + i}
+                 for i in range(tabs)],
+    } for c in range(clients)]
+
+
+def payload_size(records):
+    return sum(len(json.dumps(r)) for r in records)
@@ -0,0 +1,249 @@
+"""
+Benchmark each QuteFoxClient command against a local mock Sync server.
+
+Every command runs in its own process on a fresh copy of a synthetic
+profile, twice: "cold" with an empty mirror, then "warm" on the state the
+first run left. Wall time and peak RSS are measured by the child, request
+count and bytes transferred by the mock server.
+
+    python bench/run.py --visits 100000
+    python bench/run.py --compare bench/results/<old commit>.json
+"""
+import argparse
+import base64
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+sys.path[:0] = [str(BENCH_DIR), str(REPO_DIR)]
+
+from crypto import (CollectionKeys, KeyBundle, encrypt_payload,  # noqa: E402
+                    self_check)
+from mock_server import MockSyncServer  # noqa: E402
+import profiles  # noqa: E402
+
+FOLDER_ID = 'benchfolder'
+COMMANDS = {
+    'upload_qute_history': {},
+    'download_ff_history': {},
+    'upload_qute_bookmarks': {},
+    'download_ff_bookmarks': {'folder_id': FOLDER_ID},
+    'create_qutebrowser_sessions': {},
+    'update_ff_session': {},
+}
+METRICS = ('wall', 'requests', 'bytes_sent', 'bytes_received', 'max_rss_kb')
+
+
+def make_profile(root, args):
+    data = root/'data/qutebrowser'
+    config = root/'config/qutebrowser'
+    (data/'sessions').mkdir(parents=True)
+    (root/'data/qutefox-sync').mkdir(parents=True)
+    profiles.make_qute_history(data/'history.sqlite', args.visits)
+    profiles.make_qute_bookmarks(config/'bookmarks/urls', args.bookmarks)
+    profiles.make_qute_session(data/'sessions/default.yml', args.tabs,
+                               windows=args.windows)
+
+
+def seed_server(mock, kb):
+    """
+    Store encrypted copies of the synthetic Firefox data on the mock,
+    with crypto/keys wrapped by the key bundle derived from `kb`.
+    """
+    keys = {'id': 'keys', 'collection': 'crypto', 'collections': {},
+            'default': [base64.b64encode(os.urandom(32)).decode('ascii')
+                        for _ in range(2)]}
+    crypto_modified = mock.put('crypto', [{
+        'id': 'keys',
+        'payload': encrypt_payload(json.dumps(keys), KeyBundle.from_kb(kb))}])
+    bundle = CollectionKeys(keys).default
+
+    def encrypted(records):
+        return [{'id': r['id'], 'payload': encrypt_payload(json.dumps(r),
+                                                           bundle)}
+                for r in records]
+
+    return keys, crypto_modified, encrypted
+
+
+def seed_collections(mock, args, encrypted):
+    mock.put('history', encrypted(profiles.make_ff_history(
+        args.ff_history, offset=args.ff_history // 2)))
+    mock.put('bookmarks', encrypted(profiles.make_ff_bookmarks(
+        args.ff_bookmarks, FOLDER_ID)))
+    mock.put('tabs', encrypted(profiles.make_ff_tabs(args.clients,
+                                                     args.tabs)))
+
+
+def seed_credentials(root, mock, keys, crypto_modified):
+    """Cache credentials so that no FxA login is needed."""
+    expires = time.time() + 86400
+    credentials = {
+        'hawk': {'value': mock.credentials(), 'expires': expires},
+        'collection_keys': {'value': {'payload': keys,
+                                      'modified': crypto_modified},
+                            'expires': None},
+        # the device id normally comes from the FxA device list; the empty
+        # hash makes the first run post the client record
+        'client_record': {'value': {'id': 'benchdevice', 'hash': ''},
+                          'expires': time.time() + 30 * 86400},
+    }
+    path = root/'data/qutefox-sync/credentials.json'
+    path.write_text(json.dumps(credentials))
+    path.chmod(0o600)
+
+
+def run_child(root, command, verbose=False):
+    env = dict(os.environ, XDG_DATA_HOME=str(root/'data'),
+               XDG_CONFIG_HOME=str(root/'config'))
+    env.pop('QUTE_MODE', None)
+    result = subprocess.run(
+        [sys.executable, __file__, '--child', command],
+        env=env, stdout=subprocess.PIPE,
+        stderr=None if verbose else subprocess.DEVNULL, check=True)
+    return json.loads(result.stdout.decode('utf-8').splitlines()[-1])
+
+
+def child(command):
+    import logging
+    import qutefox
+
+    logging.getLogger('qutefox').setLevel(logging.WARNING)
+    qutefox_client = qutefox.QuteFoxClient('bench', 'bench')
+    start = time.perf_counter()
+    if command != 'noop':
+        getattr(qutefox_client, command)(**COMMANDS[command])
+    wall = time.perf_counter() - start
+    max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print(json.dumps({'wall': wall, 'max_rss_kb': max_rss}))
+
+
+def measure(mock, root, command, verbose=False):
+    mock.reset_stats()
+    result = run_child(root, command, verbose)
+    result.update(mock.stats)
+    return result
+
+
+def run(args):
+    # the mock is seeded with our own encryption, which must be sound
+    self_check()
+    kb = os.urandom(32)
+    mock = MockSyncServer()
+    mock.start()
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory(prefix='qutefox-bench') as tmp:
+            template = Path(tmp)/'template'
+            make_profile(template, args)
+            keys, crypto_modified, encrypted = seed_server(mock, kb)
+            seed_collections(mock, args, encrypted)
+            seed_credentials(template, mock, keys, crypto_modified)
+            seeded = mock.snapshot()
+            # registers the client record once, so that the commands below
+            # only measure their own work
+            results['startup'] = {'cold': measure(mock, template, 'noop',
+                                                  args.verbose)}
+            for command in args.commands:
+                mock.restore(seeded)
+                root = Path(tmp)/command
+                shutil.copytree(template, root)
+                results[command] = {
+                    phase: measure(mock, root, command, args.verbose)
+                    for phase in ('cold', 'warm')}
+                shutil.rmtree(root)
+                print_result(command, results[command])
+    finally:
+        mock.stop()
+    return results
+
+
+def print_result(command, result):
+    for phase, metrics in result.items():
+        print(f'{command:28} {phase:5} {metrics["wall"]:8.3f}s '
+              f'{metrics["requests"]:6} req '
+              f'{metrics["bytes_sent"] + metrics["bytes_received"]:>11} B '
+              f'{metrics["max_rss_kb"]:>8} KiB')
+
+
+def compare(old, new):
+    print(f'{"":28} {"":5} ' + ' '.join(f'{m:>14}' for m in METRICS))
+    for command, phases in new['results'].items():
+        for phase, metrics in phases.items():
+            before = old['results'].get(command, {}).get(phase)
+            if before is None:
+                continue
+            ratios = []
+            for metric in METRICS:
+                ratio = metrics[metric] / before[metric] \
+                    if before[metric] else None
+                ratios.append(f'{"-":>14}' if ratio is None
+                              else f'{ratio:>13.2f}x')
+            print(f'{command:28} {phase:5} ' + ' '.join(ratios))
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            check=True).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--visits', type=int, default=100000,
+                        help='visits in the qutebrowser history')
+    parser.add_argument('--bookmarks', type=int, default=50000,
+                        help='lines in the qutebrowser bookmarks file')
+    parser.add_argument('--tabs', type=int, default=300,
+                        help='tabs per session, local and remote')
+    parser.add_argument('--windows', type=int, default=3,
+                        help='windows of the local session')
+    parser.add_argument('--clients', type=int, default=3,
+                        help='remote Firefox clients with open tabs')
+    parser.add_argument('--ff-history', type=int, default=20000,
+                        help='history records on the server')
+    parser.add_argument('--ff-bookmarks', type=int, default=5000,
+                        help='bookmarks in the synced Firefox folder')
+    parser.add_argument('--commands', nargs='+', default=list(COMMANDS),
+                        choices=list(COMMANDS))
+    parser.add_argument('--output', type=Path,
+                        help='defaults to bench/results/<commit>.json')
+    parser.add_argument('--compare', type=Path,
+                        help='previous results to compare against')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the output of the benchmarked commands')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    commit = git_commit()
+    params = {k: v for k, v in vars(args).items()
+              if k not in ('output', 'compare', 'verbose', 'child')}
+    results = {'commit': commit, 'time': time.time(), 'params': params,
+               'results': run(args)}
+    output = args.output or BENCH_DIR/f'results/{commit}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f'Results saved to {output}')
+    if args.compare:
+        compare(json.loads(args.compare.read_text()), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import hashlib
+import logging
+import os
+import tempfile
+from collections import namedtuple
+from pathlib import Path
+
+logger = logging.getLogger('qutefox')
+
+# Changes needed to make a Firefox folder match qutebrowser's bookmarks:
+#   added: urls only in qutebrowser
+#   removed: Firefox bookmark records only in the folder
+#   moved: Firefox bookmark records for urls in qutebrowser that are stored
+#       outside the folder
+BookmarkDelta = namedtuple('BookmarkDelta', ['added', 'removed', 'moved'])
+
+
+def bookmark_id(url):
+    # qutebrowser enforces no url duplicates
+    # so we can obtain a unique ID from the (unique) url
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()[:10]
+
+
+class BookmarkStore():
+    """
+    qutebrowser's bookmarks/urls file, as an ordered dict of url -> title.
+
+    The parsed file is kept until its mtime or size change, so repeated
+    syncs of an unchanged file do not parse it again.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.bookmarks = {}
+        self._signature = None
+
+    def _stat(self):
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def exists(self):
+        return self._stat() is not None
+
+    def load(self):
+        """Return the bookmarks, reading the file only if it changed."""
+        signature = self._stat()
+        if signature != self._signature:
+            self.bookmarks = {}
+            if signature is not None:
+                with open(self.path) as f:
+                    for line in f:
+                        url, _, title = line.rstrip('\n').partition(' ')
+                        if url:
+                            self.bookmarks[url] = title
+            self._signature = signature
+        return self.bookmarks
+
+    def merge(self, bookmarks):
+        """
+        Add the (url, title) pairs whose url is not bookmarked yet, keeping
+        existing titles. Return the urls added.
+        """
+        current = self.load()
+        added = []
+        for url, title in bookmarks:
+            if not url or url in current:
+                continue
+            # the file has one bookmark per line
+            current[url] = ' '.join((title or '').split())
+            added.append(url)
+        return added
+
+    def save(self):
+        """
+        Write the bookmarks back through a temporary file renamed over the
+        original, so the file is never left half written.
+        """
+        # follow symlinks, e.g. into a dotfiles repository
+        path = self.path.resolve()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent,
+                                        prefix=f'.{path.name}.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for url, title in self.bookmarks.items():
+                    f.write(f'{url} {title}\n' if title else f'{url}\n')
+                f.flush()
+                os.fsync(f.fileno())
+            if path.exists():
+                os.chmod(tmp_path, path.stat().st_mode & 0o7777)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._signature = self._stat()
+
+
+class BookmarkTree():
+    """
+    Index of the records of a bookmarks collection, built once per fetch.
+    """
+
+    def __init__(self, records):
+        self.by_id = {}
+        self.by_url = {}
+        self.children = {}
+        for record in records:
+            if record.get('deleted') or not record.get('id'):
+                continue
+            self.by_id[record['id']] = record
+            if record.get('type') == 'bookmark' and record.get('bmkUri'):
+                self.by_url.setdefault(record['bmkUri'], record)
+        # folders list their children in order; records whose folder does
+        # not list them (e.g. partially synced) are appended via parentid
+        listed = set()
+        for record in self.by_id.values():
+            if record.get('type') == 'folder':
+                children = [c for c in record.get('children', [])
+                            if c in self.by_id]
+                self.children[record['id']] = children
+                listed.update(children)
+        for record in self.by_id.values():
+            if record['id'] not in listed and record.get('parentid'):
+                self.children.setdefault(
+                    record['parentid'], []).append(record['id'])
+
+    def __contains__(self, record_id):
+        return record_id in self.by_id
+
+    def find_folders(self, title, parentid):
+        return [r for r in self.by_id.values()
+                if r.get('type') == 'folder'
+                and r.get('title') == title
+                and r.get('parentid') == parentid]
+
+    def walk(self, folder_id):
+        """
+        Yield the bookmark records in `folder_id` and all of its subfolders,
+        depth-first, in Firefox's order.
+        """
+        stack = [iter(self.children.get(folder_id, []))]
+        seen = {folder_id}
+        while stack:
+            child_id = next(stack[-1], None)
+            if child_id is None:
+                stack.pop()
+                continue
+            if child_id in seen:
+                logger.warning(f'Bookmark {child_id} appears twice in tree')
+                continue
+            seen.add(child_id)
+            child = self.by_id[child_id]
+            if child.get('type') == 'folder':
+                stack.append(iter(self.children.get(child_id, [])))
+            elif child.get('type') == 'bookmark':
+                if not child.get('bmkUri'):
+                    logger.warning(
+                        f'bmkUri not found for bookmark record {child_id}')
+                    continue
+                yield child
+
+    def diff(self, folder_id, qute_bookmarks):
+        """
+        Compute the BookmarkDelta between the bookmarks under `folder_id`
+        and `qute_bookmarks`, a dict keyed by url.
+        """
+        in_folder = {}
+        for record in self.walk(folder_id):
+            in_folder.setdefault(record['bmkUri'], record)
+        added = []
+        moved = []
+        for url in qute_bookmarks:
+            if url in in_folder:
+                continue
+            if url in self.by_url:
+                moved.append(self.by_url[url])
+            else:
+                added.append(url)
+        removed = [record for url, record in in_folder.items()
+                   if url not in qute_bookmarks]
+        return BookmarkDelta(added, removed, moved)
@@ -0,0 +1,62 @@
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger('qutefox')
+
+
+class CredentialCache():
+    """
+    JSON file of secrets (tokens, keys) with their expiry times, readable
+    only by the current user.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.data = {}
+        self._lock = threading.Lock()
+        if self.path.is_file():
+            try:
+                self.data = json.loads(self.path.read_text())
+            except json.JSONDecodeError:
+                logger.error('Credential cache corrupt, ignoring it.')
+
+    def get(self, key, margin=0):
+        """
+        Return the value stored under `key`, or None if it is missing or
+        expires in less than `margin` seconds.
+        """
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        expires = entry.get('expires')
+        if expires is not None and expires - margin < time.time():
+            return None
+        return entry['value']
+
+    def expiry(self, key):
+        return self.data.get(key, {}).get('expires')
+
+    def set(self, key, value, expires=None):
+        with self._lock:
+            self.data[key] = {'value': value, 'expires': expires}
+            self._save()
+
+    def delete(self, key):
+        with self._lock:
+            if self.data.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        # written aside and renamed over, so that a crash or a concurrent
+        # run never finds the secrets half written
+        tmp_path = self.path.with_name(f'.{self.path.name}.{os.getpid()}')
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # a leftover from a crashed run may have looser permissions
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(self.data))
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,173 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.hazmat.primitives import hashes, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+logger = logging.getLogger('qutefox')
+
+# lists smaller than this are decrypted in the current process, as sending
+# them to the pool would cost more than it saves
+PARALLEL_THRESHOLD = 2000
+CHUNK_SIZE = 500
+
+
+class KeyBundle():
+    def __init__(self, encryption_key, hmac_key):
+        self.encryption_key = encryption_key
+        self.hmac_key = hmac_key
+
+    @classmethod
+    def from_kb(cls, kb):
+        """Derive the Sync key bundle from the account's kB."""
+        key = HKDF(algorithm=hashes.SHA256(), length=64, salt=b'',
+                   info=b'identity.mozilla.com/picl/v1/oldsync').derive(kb)
+        return cls(key[:32], key[32:])
+
+    @classmethod
+    def from_b64(cls, keys):
+        return cls(*(base64.b64decode(k) for k in keys))
+
+
+class CollectionKeys():
+    """The decrypted crypto/keys record."""
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.default = KeyBundle.from_b64(payload['default'])
+        self.collections = {
+            name: KeyBundle.from_b64(keys)
+            for name, keys in payload.get('collections', {}).items()}
+
+    def for_collection(self, collection):
+        return self.collections.get(collection, self.default)
+
+
+class DecryptionError(Exception):
+    pass
+
+
+def decrypt_payload(payload, bundle):
+    """
+    Verify and decrypt the JSON payload of an encrypted BSO. Return the
+    cleartext JSON.
+    """
+    envelope = json.loads(payload)
+    ciphertext = envelope['ciphertext'].encode('ascii')
+    expected = hmac.new(bundle.hmac_key, ciphertext, hashlib.sha256)
+    if not hmac.compare_digest(expected.hexdigest(), envelope['hmac']):
+        raise DecryptionError('HMAC mismatch')
+    decryptor = Cipher(algorithms.AES(bundle.encryption_key),
+                       modes.CBC(base64.b64decode(envelope['IV']))
+                       ).decryptor()
+    padded = decryptor.update(base64.b64decode(ciphertext)) \
+        + decryptor.finalize()
+    unpadder = padding.PKCS7(128).unpadder()
+    return (unpadder.update(padded) + unpadder.finalize()).decode('utf-8')
+
+
+def encrypt_payload(cleartext, bundle):
+    """Encrypt the cleartext JSON of a BSO payload."""
+    padder = padding.PKCS7(128).padder()
+    padded = padder.update(cleartext.encode('utf-8')) + padder.finalize()
+    iv = os.urandom(16)
+    encryptor = Cipher(algorithms.AES(bundle.encryption_key),
+                       modes.CBC(iv)).encryptor()
+    ciphertext = base64.b64encode(encryptor.update(padded)
+                                  + encryptor.finalize())
+    return json.dumps({
+        'ciphertext': ciphertext.decode('ascii'),
+        'IV': base64.b64encode(iv).decode('ascii'),
+        'hmac': hmac.new(bundle.hmac_key, ciphertext,
+                         hashlib.sha256).hexdigest()
+    })
+
+
+def _decrypt_chunk(bsos, bundle):
+    # payloads are left as JSON text: the mirror stores them as such and
+    # parses them only when read, so parsing here would mean serializing
+    # them again
+    decrypted = []
+    for bso in bsos:
+        try:
+            payload = decrypt_payload(bso['payload'], bundle)
+        except (DecryptionError, ValueError, KeyError):
+            payload = None
+        decrypted.append(dict(bso, payload=payload))
+    return decrypted
+
+
+def decrypt_pool(processes=None):
+    """
+    Return a process pool for decrypt_records, meant to be reused for a
+    whole run. Its workers come from a fork server (or are spawned), never
+    forked from a process whose other threads may hold locks.
+    """
+    method = 'forkserver' \
+        if 'forkserver' in multiprocessing.get_all_start_methods() \
+        else 'spawn'
+    return ProcessPoolExecutor(
+        processes, mp_context=multiprocessing.get_context(method))
+
+
+def decrypt_records(bsos, bundle, pool=None):
+    """
+    Decrypt a list of BSOs as returned by the server, preserving order.
+    If a pool from decrypt_pool() is given, large lists are split in
+    chunks and decrypted in it. Records that fail verification are logged
+    and dropped.
+    """
+    if pool is None or len(bsos) < PARALLEL_THRESHOLD or \
+            (os.cpu_count() or 1) < 2:
+        decrypted = _decrypt_chunk(bsos, bundle)
+    else:
+        chunks = [bsos[i:i + CHUNK_SIZE]
+                  for i in range(0, len(bsos), CHUNK_SIZE)]
+        decrypted = [bso for chunk in pool.map(
+            _decrypt_chunk, chunks, [bundle] * len(chunks))
+            for bso in chunk]
+    failed = [bso['id'] for bso in decrypted if bso['payload'] is None]
+    if failed:
+        logger.error(f'Could not decrypt {len(failed)} records: '
+                     + ', '.join(failed[:10]))
+    return [bso for bso in decrypted if bso['payload'] is not None]
+
+
+def self_check():
+    """
+    Check that payloads survive an encrypt/decrypt round trip and that a
+    wrong HMAC or key is rejected. Raise AssertionError otherwise.
+    """
+    bundle = KeyBundle.from_kb(os.urandom(32))
+    cleartext = json.dumps({'id': 'check', 'title': 'caf\u00e9 \u2713'})
+    payload = encrypt_payload(cleartext, bundle)
+    assert decrypt_payload(payload, bundle) == cleartext
+    envelope = json.loads(payload)
+    envelope['hmac'] = ('0' if envelope['hmac'][0] != '0' else '1') \
+        + envelope['hmac'][1:]
+    for bad_payload, bad_bundle in (
+            (json.dumps(envelope), bundle),
+            (payload, KeyBundle.from_kb(os.urandom(32)))):
+        try:
+            decrypt_payload(bad_payload, bad_bundle)
+        except DecryptionError:
+            pass
+        else:
+            raise AssertionError('HMAC mismatch not detected')
+    bsos = [{'id': str(i), 'payload': encrypt_payload(cleartext, bundle)}
+            for i in range(3)]
+    bsos[1]['payload'] = json.dumps(envelope)
+    assert [b['payload'] for b in _decrypt_chunk(bsos, bundle)] == \
+        [cleartext, None, cleartext]
+
+
+if __name__ == '__main__':
+    self_check()
+    print('crypto self-check passed')
@@ -0,0 +1,220 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+
+logger = logging.getLogger('qutefox')
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify():
+    """Minimal inotify wrapper over libc, yielding changed paths."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'Cannot watch {path}')
+        self.watches[wd] = Path(path)
+
+    def fileno(self):
+        return self.fd
+
+    def read_events(self):
+        """Return the paths of all pending events."""
+        paths = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return paths
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if wd in self.watches:
+                    paths.append(self.watches[wd]/os.fsdecode(name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SyncDaemon():
+    """
+    Keep one authenticated QuteFoxClient alive, upload local changes once
+    they settle for `debounce` seconds and poll info/collections every
+    `poll_interval` seconds for remote changes. `after_sync` is called
+    after each of these. Nothing is synced while the server asked us to
+    back off; local changes are kept until it is over.
+    """
+
+    def __init__(self, qutefox, data_dir, config_dir, debounce=5,
+                 poll_interval=300, upload_bookmark_args=None,
+                 download_bookmark_args=None, after_sync=None):
+        self.qutefox = qutefox
+        self.data_dir = Path(data_dir)
+        self.config_dir = Path(config_dir)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.upload_bookmark_args = upload_bookmark_args or {}
+        self.download_bookmark_args = download_bookmark_args or {}
+        self.after_sync = after_sync
+        self.remote_collections = None
+        # sessions we write for remote clients must not be uploaded back
+        self.remote_sessions = set()
+
+    def classify(self, path):
+        if path.parent == self.data_dir and \
+                path.name.startswith('history.sqlite'):
+            return 'history'
+        if path == self.config_dir/'bookmarks/urls':
+            return 'bookmarks'
+        if path.parent == self.data_dir/'sessions' and \
+                path.suffix == '.yml' and \
+                path.stem not in self.remote_sessions:
+            return ('session', path.stem)
+        return None
+
+    def sync_local(self, targets):
+        """
+        Upload the changed targets. Return those whose upload was refused
+        twice because another client changed the collection meanwhile.
+        """
+        logger.info('Local changes detected, syncing: '
+                    + ', '.join(sorted(str(t) for t in targets)))
+        refused = set()
+        for target in sorted(targets, key=str):
+            if target == 'history':
+                uploaded = self._upload(self.qutefox.upload_qute_history)
+            elif target == 'bookmarks':
+                uploaded = self._upload(self.qutefox.upload_qute_bookmarks,
+                                        **self.upload_bookmark_args)
+            else:
+                uploaded = self._run(self.qutefox.update_ff_session,
+                                     session_name=target[1])
+            if uploaded is False:
+                refused.add(target)
+        return refused
+
+    def _upload(self, method, **kwargs):
+        # uploads only succeed if the collection is unchanged since the
+        # last poll; when another client wrote to it in between, poll it
+        # again so that the retry merges its changes
+        if self._run(method, **kwargs) is not False:
+            return True
+        logger.info(f'Retrying {method.__name__} with the latest server '
+                    'state')
+        if self._run(self.qutefox.get_server_collections,
+                     refresh=True) is None:
+            return False
+        return self._run(method, **kwargs)
+
+    def sync_remote(self):
+        collections = self._run(self.qutefox.get_server_collections,
+                                refresh=True)
+        if collections is None:
+            return
+        previous = self.remote_collections or {}
+        changed = {name for name in ('tabs', 'bookmarks', 'history')
+                   if self.remote_collections is None
+                   or collections.get(name) != previous.get(name)}
+        self.remote_collections = collections
+        if not changed:
+            logger.debug('No remote changes')
+            return
+        logger.info('Remote changes detected in: '
+                    + ', '.join(sorted(changed)))
+        if 'tabs' in changed:
+            sessions = self._run(self.qutefox.create_qutebrowser_sessions)
+            self.remote_sessions.update(sessions or [])
+        if 'bookmarks' in changed and self.download_bookmark_args:
+            self._run(self.qutefox.download_ff_bookmarks,
+                      **self.download_bookmark_args)
+        if 'history' in changed:
+            self._run(self.qutefox.download_ff_history)
+
+    def _run(self, method, *args, **kwargs):
+        # a failed sync must not bring the daemon down
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            logger.exception(f'{method.__name__} failed')
+            return None
+
+    def _after_sync(self):
+        if self.after_sync is not None:
+            self._run(self.after_sync)
+
+    def run(self):
+        # targets refused by the server are uploaded again after the next
+        # poll has brought in the changes they conflicted with
+        refused = set()
+        inotify = Inotify()
+        inotify.add_watch(self.data_dir)
+        inotify.add_watch(self.data_dir/'sessions')
+        inotify.add_watch(self.config_dir/'bookmarks')
+        logger.info('Watching for changes...')
+        pending = set()
+        last_event = 0
+        last_poll = None
+        backing_off = False
+        try:
+            while True:
+                now = time.monotonic()
+                backoff = self.qutefox.backoff.remaining()
+                if backoff and not backing_off:
+                    logger.info(f'Server asked to back off, pausing sync '
+                                f'for {backoff:.0f}s')
+                backing_off = bool(backoff)
+                if not backoff and (last_poll is None or
+                                    now - last_poll >= self.poll_interval):
+                    self.sync_remote()
+                    self._after_sync()
+                    # ignore the events caused by our own writes
+                    inotify.read_events()
+                    last_poll = time.monotonic()
+                    pending |= refused
+                    refused = set()
+                    continue
+                if backoff:
+                    timeout = backoff
+                else:
+                    timeout = self.poll_interval - (now - last_poll)
+                    if pending:
+                        timeout = min(timeout,
+                                      self.debounce - (now - last_event))
+                ready, _, _ = select.select([inotify], [], [],
+                                            max(timeout, 0))
+                if ready:
+                    for path in inotify.read_events():
+                        target = self.classify(path)
+                        if target is not None:
+                            pending.add(target)
+                            last_event = time.monotonic()
+                if pending and not self.qutefox.backoff.remaining() and \
+                        time.monotonic() - last_event >= self.debounce:
+                    refused |= self.sync_local(pending)
+                    self._after_sync()
+                    pending = set()
+        finally:
+            inotify.close()
@@ -0,0 +1,74 @@
+import getpass
+import hashlib
+import json
+import logging
+import os
+import socket
+from pathlib import Path
+
+logger = logging.getLogger('qutefox')
+
+# version of qutebrowser's IPC protocol, see qutebrowser/misc/ipc.py
+PROTOCOL_VERSION = 1
+TIMEOUT = 2
+
+
+def socket_path(basedir=None):
+    """
+    Return the path of the IPC socket of the qutebrowser instance using
+    `basedir`, or the default instance when it is None.
+    """
+    parts = [getpass.getuser()]
+    if basedir is not None:
+        parts.append(str(basedir))
+    digest = hashlib.md5('-'.join(parts).encode('utf-8')).hexdigest()
+    if basedir is not None:
+        runtime_dir = Path(basedir)/'runtime'
+    else:
+        runtime_dir = Path(os.environ.get('XDG_RUNTIME_DIR')
+                           or f'/tmp/runtime-{getpass.getuser()}') \
+            / 'qutebrowser'
+    return runtime_dir/f'ipc-{digest}'
+
+
+class QuteIPC():
+    """
+    Send commands to a running qutebrowser: through QUTE_FIFO when running
+    as a userscript, through its IPC socket otherwise. Unlike running
+    `qutebrowser :command`, no new Python interpreter is started.
+    """
+
+    def __init__(self, fifo=None, basedir=None):
+        self.fifo = fifo
+        self.basedir = basedir
+
+    def send(self, *commands):
+        """
+        Run `commands` (with or without the leading colon) in one message.
+        Return False if qutebrowser could not be reached.
+        """
+        commands = [c.lstrip(':') for c in commands]
+        if not commands:
+            return True
+        if self.fifo:
+            with open(self.fifo, 'w') as fifo:
+                fifo.write(''.join(f'{c}\n' for c in commands))
+            return True
+        message = json.dumps({
+            # arguments starting with a colon are run as commands
+            'args': [f':{c}' for c in commands],
+            'target_arg': None,
+            'protocol_version': PROTOCOL_VERSION,
+            'cwd': os.getcwd(),
+        }) + '\n'
+        path = socket_path(self.basedir)
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(TIMEOUT)
+                sock.connect(str(path))
+                sock.sendall(message.encode('utf-8'))
+        except OSError as e:
+            logger.warning(f'Could not reach qutebrowser at {path}: {e}')
+            return False
+        logger.debug('Sent to qutebrowser: ' + '; '.join(commands))
+        return True
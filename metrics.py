@@ -0,0 +1,214 @@
+import copy
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger('qutefox')
+
+PROMETHEUS_PREFIX = 'qutefox'
+
+
+class Metrics():
+    """
+    Phase timings and counters of one run, shared by all threads.
+
+    Phases with the same name add up, so phases running concurrently in
+    sync-all can add up to more than the wall time.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.phases = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+        self.counters = defaultdict(float)
+        self.collectors = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[name]['calls'] += 1
+                self.phases[name]['seconds'] += elapsed
+
+    def incr(self, name, value=1, **labels):
+        """Add `value` to the counter `name` with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += value
+
+    def set(self, name, value, **labels):
+        """Set the counter `name` with the given labels to `value`."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = value
+
+    def add_collector(self, collector):
+        """
+        Register a function called with this object before the metrics
+        are read, to set values kept elsewhere.
+        """
+        self.collectors.append(collector)
+
+    def as_dict(self):
+        for collector in self.collectors:
+            collector(self)
+        with self._lock:
+            counters = defaultdict(list)
+            for (name, labels), value in sorted(self.counters.items()):
+                counters[name].append(dict(labels, value=value))
+            return {
+                'started': self.started,
+                'duration': time.time() - self.started,
+                'phases': copy.deepcopy(dict(self.phases)),
+                'counters': dict(counters),
+            }
+
+    def as_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        data = self.as_dict()
+        lines = []
+
+        def metric(name, help_text, samples):
+            name = f'{PROMETHEUS_PREFIX}_{name}'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in samples:
+                label_text = ','.join(
+                    f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+                if label_text:
+                    label_text = '{' + label_text + '}'
+                lines.append(f'{name}{label_text} {value}')
+
+        metric('last_run_timestamp_seconds', 'Start time of the last run.',
+               [({}, data['started'])])
+        metric('last_run_duration_seconds', 'Duration of the last run.',
+               [({}, data['duration'])])
+        metric('phase_seconds', 'Time spent in each phase of the last run.',
+               [({'phase': name}, phase['seconds'])
+                for name, phase in sorted(data['phases'].items())])
+        metric('phase_calls', 'Times each phase ran in the last run.',
+               [({'phase': name}, phase['calls'])
+                for name, phase in sorted(data['phases'].items())])
+        for name, samples in data['counters'].items():
+            metric(name, f'{name.replace("_", " ").capitalize()} in the '
+                   'last run.',
+                   [({k: v for k, v in s.items() if k != 'value'},
+                     s['value']) for s in samples])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Write the metrics to `path`, in the Prometheus text format if it
+        ends in .prom and as JSON otherwise. The file is replaced
+        atomically, so collectors never read a partial file.
+        """
+        path = Path(path)
+        if path.suffix == '.prom':
+            text = self.as_prometheus()
+        else:
+            text = json.dumps(self.as_dict(), indent=2)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}')
+        tmp_path.write_text(text)
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        phases = sorted(self.as_dict()['phases'].items(),
+                        key=lambda p: p[1]['seconds'], reverse=True)
+        return ', '.join(f'{name} {phase["seconds"]:.3f}s'
+                         for name, phase in phases)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def timed(name):
+    """Decorator timing a method as phase `name` of self.metrics."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class InstrumentedSyncClient():
+    """
+    Proxy of a syncclient.SyncClient timing each call as the "http" phase
+    and counting requests and bytes from the response it leaves in
+    raw_resp.
+    """
+
+    def __init__(self, sync_client, metrics):
+        self._sync_client = sync_client
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._sync_client, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            previous = getattr(self._sync_client, 'raw_resp', None)
+            try:
+                with self._metrics.phase('http'):
+                    return attr(*args, **kwargs)
+            finally:
+                response = getattr(self._sync_client, 'raw_resp', None)
+                if response is not None and response is not previous:
+                    self._count(response)
+        return call
+
+    def __copy__(self):
+        # each thread gets its own copy, see QuteFoxClient.sync_client
+        return InstrumentedSyncClient(copy.copy(self._sync_client),
+                                      self._metrics)
+
+    def _count(self, response):
+        request = response.request
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self._metrics.incr('http_requests', method=request.method,
+                           status=response.status_code)
+        self._metrics.incr('http_request_bytes', len(body))
+        self._metrics.incr('http_response_bytes', len(response.content))
+
+
+class Progress():
+    """Log the progress and throughput of a long import or export."""
+
+    def __init__(self, label, total, unit='records'):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.done = 0
+        self.start = time.monotonic()
+
+    def update(self, count):
+        self.done += count
+        elapsed = time.monotonic() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        message = f'{self.label}: {self.done}'
+        if self.total:
+            message += f'/{self.total} {self.unit} ' \
+                f'({100 * self.done / self.total:.0f}%)'
+        else:
+            message += f' {self.unit}'
+        message += f', {rate:.0f} {self.unit}/s'
+        if self.total and rate and self.done < self.total:
+            message += f', {(self.total - self.done) / rate:.0f}s left'
+        logger.info(message)
@@ -0,0 +1,167 @@
+import json
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger('qutefox')
+
+
+class Mirror():
+    """
+    Local copy of the decrypted BSOs of each Sync collection, kept up to date
+    incrementally using the server's modified timestamps.
+
+    Each thread gets its own connection; writes are serialized.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self.db.execute('PRAGMA journal_mode = WAL;')
+        with self.db as db:
+            db.execute('CREATE TABLE IF NOT EXISTS Collections '
+                       '(name TEXT PRIMARY KEY, modified REAL NOT NULL);')
+            db.execute('CREATE TABLE IF NOT EXISTS Records '
+                       '(collection TEXT NOT NULL, id TEXT NOT NULL, '
+                       'modified REAL NOT NULL, payload TEXT NOT NULL, '
+                       'PRIMARY KEY (collection, id));')
+            # ordered by id within a timestamp, so that records committed
+            # in one batch can be paged through with a (modified, id) key
+            db.execute('CREATE INDEX IF NOT EXISTS RecordsModifiedId '
+                       'ON Records (collection, modified, id);')
+            db.execute("CREATE INDEX IF NOT EXISTS HistoryUri ON Records "
+                       "(json_extract(payload, '$.histUri')) "
+                       "WHERE collection = 'history';")
+
+    @property
+    def db(self):
+        if getattr(self._local, 'db', None) is None:
+            self._local.db = sqlite3.connect(self.path, timeout=60)
+        return self._local.db
+
+    def last_modified(self, collection):
+        row = self.db.execute(
+            'SELECT modified FROM Collections WHERE name = ?;',
+            (collection,)).fetchone()
+        return row[0] if row else None
+
+    def is_stale(self, collection, server_modified):
+        """
+        Compare the mirrored collection against its timestamp in
+        info/collections. A server timestamp older than ours means the
+        collection was wiped or reset, so the mirror must be cleared.
+        """
+        local_modified = self.last_modified(collection)
+        if local_modified is None:
+            return True
+        if server_modified is None and local_modified == 0:
+            # still missing on the server
+            return False
+        if server_modified is None or server_modified < local_modified:
+            logger.warning(f'Server copy of {collection} went back in time, '
+                           'invalidating mirror')
+            self.clear(collection)
+            return True
+        return server_modified > local_modified
+
+    def add(self, collection, bsos):
+        """
+        Store the given BSOs, as returned by get_records with decrypt=True.
+        """
+        with self._write_lock, self.db as db:
+            db.executemany(
+                'INSERT OR REPLACE INTO Records VALUES (?, ?, ?, ?);',
+                ((collection, bso['id'], bso['modified'], bso['payload'])
+                 for bso in bsos))
+
+    def retain(self, collection, ids):
+        """
+        Delete the records of `collection` whose id is not in `ids`. Return
+        the number of records deleted.
+        """
+        ids = set(ids)
+        with self._write_lock, self.db as db:
+            gone = [(collection, i) for (i,) in db.execute(
+                'SELECT id FROM Records WHERE collection = ?;', (collection,))
+                if i not in ids]
+            db.executemany(
+                'DELETE FROM Records WHERE collection = ? AND id = ?;', gone)
+        return len(gone)
+
+    def set_modified(self, collection, modified):
+        """Mark the collection as up to date with the server at `modified`.
+        """
+        with self._write_lock, self.db as db:
+            db.execute('INSERT OR REPLACE INTO Collections VALUES (?, ?);',
+                       (collection, modified))
+
+    def clear(self, collection):
+        with self._write_lock, self.db as db:
+            db.execute('DELETE FROM Records WHERE collection = ?;',
+                       (collection,))
+            db.execute('DELETE FROM Collections WHERE name = ?;',
+                       (collection,))
+
+    def records(self, collection, newer=None):
+        """
+        Yield the parsed payloads of a collection, oldest first. If `newer`
+        is given, only records modified after it are returned.
+        """
+        query = 'SELECT payload FROM Records WHERE collection = ?'
+        params = [collection]
+        if newer is not None:
+            query += ' AND modified > ?'
+            params.append(newer)
+        for (payload,) in self.db.execute(query + ' ORDER BY modified;',
+                                          params):
+            yield json.loads(payload)
+
+    def count(self, collection, newer=None, after=None):
+        """Count the records pages() would yield."""
+        query = 'SELECT count(*) FROM Records WHERE collection = ?'
+        params = [collection]
+        if newer is not None:
+            query += ' AND modified > ?'
+            params.append(newer)
+        if after is not None:
+            query += ' AND (modified, id) > (?, ?)'
+            params.extend(after)
+        return self.db.execute(query + ';', params).fetchone()[0]
+
+    def pages(self, collection, size, newer=None, after=None):
+        """
+        Yield (key, payloads) for the records of a collection modified
+        after `newer`, `size` records at a time, in (modified, id) order.
+        `key` identifies the last record of the page; passing it back as
+        `after` resumes with the following record.
+        """
+        first_query = ('SELECT modified, id, payload FROM Records '
+                       'WHERE collection = ? AND modified > ? '
+                       'ORDER BY modified, id LIMIT ?;')
+        # the bare modified bound is what the index seek starts from; the
+        # row value alone would make every page scan the ones before it
+        next_query = ('SELECT modified, id, payload FROM Records '
+                      'WHERE collection = ? AND modified >= ? '
+                      'AND (modified, id) > (?, ?) '
+                      'ORDER BY modified, id LIMIT ?;')
+        newer = newer if newer is not None else -1
+        while True:
+            if after is None or after[0] <= newer:
+                rows = self.db.execute(first_query,
+                                       (collection, newer, size)).fetchall()
+            else:
+                rows = self.db.execute(next_query,
+                                       (collection, after[0], *after,
+                                        size)).fetchall()
+            if not rows:
+                return
+            after = rows[-1][:2]
+            yield list(after), [json.loads(row[2]) for row in rows]
+
+    def find_history(self, url):
+        """Return the parsed history record for `url`, or None."""
+        row = self.db.execute(
+            "SELECT payload FROM Records WHERE collection = 'history' "
+            "AND json_extract(payload, '$.histUri') = ?;", (url,)).fetchone()
+        return json.loads(row[0]) if row else None
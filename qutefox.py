@@ -1,16 +1,33 @@
 import argparse
+import copy
+import cProfile
+import functools
 import json
 import yaml
 import os
 import logging
 import hashlib
+import itertools
 import math
-import subprocess
 import time
 import sqlite3
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from syncclient import client
+from backoff import BackoffWindow, RequestScheduler
+from batch import BatchUploader, PreconditionFailed
+from daemon import SyncDaemon
+from ipc import QuteIPC
+from credentials import CredentialCache
+from crypto import (CollectionKeys, KeyBundle, decrypt_payload,
+                    decrypt_pool, decrypt_records, encrypt_payload)
+from bookmarks import BookmarkStore, BookmarkTree, bookmark_id
+from metrics import InstrumentedSyncClient, Metrics, Progress, timed
+from mirror import Mirror
+from transport import Transport
 
 logging.basicConfig(encoding='utf-8', level=logging.ERROR)
 logger = logging.getLogger('qutefox')
@@ -20,6 +37,32 @@ logger.setLevel(logging.DEBUG)
 FXA_CLIENT_NAME = 'Python Sync Client'
 FXA_CLIENT_VERSION_MAJOR = '0.9'
 CLIENT_NAME = 'qutesyncclient'
+# Firefox only keeps the most recent visits of each history record
+FF_MAX_VISITS = 20
+# number of records requested per GET when downloading a collection
+PAGE_SIZE = 5000
+# the history import and export commit and checkpoint their progress
+# every IMPORT_CHUNK records and EXPORT_CHUNK urls
+IMPORT_CHUNK = 5000
+EXPORT_CHUNK = 10000
+# the client record expires after 21 days; re-register when less than a
+# week is left
+CLIENT_RECORD_TTL = 1814400
+CLIENT_RECORD_MARGIN = 604800
+# like Firefox, tabs records expire after 21 days; an unchanged record is
+# re-posted when it gets close to expiry
+TABS_TTL = CLIENT_RECORD_TTL
+# collections whose records expire on the server, which leaves no
+# tombstone and does not change the collection's timestamp
+EXPIRING_COLLECTIONS = ('tabs', 'clients')
+# cached tokens are not used when about to expire
+TOKEN_MARGIN = 60
+# path of the tokenserver request exchanging an OAuth token for a sync token
+TOKENSERVER_PATH = '/1.0/sync/1.5'
+# larger bookmark changes are applied in qutebrowser by reloading the file
+BOOKMARK_DELTA_MAX = 5000
+# how long to wait for qutebrowser to save the session we upload
+SESSION_SAVE_TIMEOUT = 5
 
 
 class UserScript():
@@ -29,15 +72,14 @@ class UserScript():
         self.config_dir = os.environ.get("QUTE_CONFIG_DIR")
         self.fifo = os.environ.get("QUTE_FIFO")
 
-    def run_command(self, command, args):
-        with open(self.fifo, 'w') as fifo:
-            fifo.write(command + ' ' + args.join(' '))
+    def run_command(self, command, args=()):
+        QuteIPC(fifo=self.fifo).send(' '.join([command, *args]))
 
 
 if os.environ.get("QUTE_MODE"):
     userscript = UserScript()
-    QUTEBROSER_DATA_DIR = userscript.data_dir
-    QUTEBROSER_CONFIG_DIR = userscript.data_dir
+    QUTEBROSER_DATA_DIR = Path(userscript.data_dir)
+    QUTEBROSER_CONFIG_DIR = Path(userscript.config_dir)
 else:
     userscript = None
     QUTEBROSER_DATA_DIR = Path(os.environ.get("XDG_DATA_HOME"))/'qutebrowser'
@@ -45,42 +87,210 @@ else:
         Path(os.environ.get("XDG_CONFIG_HOME"))/'qutebrowser'
 os.environ['FXA_SESSION_FILE'] = str(
     Path(os.environ.get("XDG_DATA_HOME"))/'qutefox-sync/fxa_session.json')
+BACKOFF_FILE = Path(os.environ.get("XDG_DATA_HOME"))/'qutefox-sync/backoff'
+
+
+# use libyaml when available, it is much faster on large sessions
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+def _digest(obj):
+    return hashlib.sha1(
+        json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _visit_date(visit):
+    return visit.get('date') or 0
+
+
+def _as_json(response):
+    # some syncclient calls return the raw response body
+    if isinstance(response, (str, bytes)):
+        return json.loads(response)
+    return response
+
+
+class RenewingSyncClient():
+    """
+    Proxy of the sync client of a QuteFoxClient that, when the storage
+    server rejects its token (401: revoked, or the user moved to another
+    node), drops the cached credentials and retries the call once with a
+    new client.
+    """
+
+    def __init__(self, qutefox):
+        self._qutefox = qutefox
+
+    def __getattr__(self, name):
+        attr = getattr(self._qutefox.current_sync_client, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            rejected = self._qutefox._sync_client
+            try:
+                return attr(*args, **kwargs)
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 401:
+                    raise
+            logger.warning('Sync token rejected by the server, renewing it')
+            self._qutefox.drop_sync_client(rejected)
+            return getattr(self._qutefox.current_sync_client, name)(
+                *args, **kwargs)
+        return call
 
 
 class QuteFoxClient():
     def __init__(self, login, client_id, token_ttl=3600,
-                 send_qute_commands=False):
+                 send_qute_commands=False, metrics=None):
         # self.read_qute_history()
         # return
+        self.metrics = metrics or Metrics()
         self.init_sync_file()
+        # syncclient and the FxA client share pooled keep-alive sessions,
+        # which retry requests and record backoffs asked by the servers
+        self.backoff = BackoffWindow(BACKOFF_FILE)
+        self.transport = Transport(RequestScheduler(self.backoff))
+        self.transport.install(client)
+        self.metrics.add_collector(self.transport.collect)
         if self.last_sync:
             logger.info(f'Last sync: {self.last_sync.get("sync_time")}')
         else:
             logger.info('Syncing for the first time...')
-        self.fxa_session = client.get_fxa_session(login)
-        logger.debug('FXA session obtained')
+        self.login = login
         self.client_id = client_id
-        # get an OAuth access token...
-        self.access_token, _ = client.create_oauth_token(
-            self.fxa_session, client_id, token_ttl=token_ttl,
-            with_refresh=False)
-        logger.debug('Access token obtained')
-
-        # create an authorized sync client...
-        self.sync_client = client.get_sync_client(
-            self.fxa_session, self.client_id, self.access_token,
-            token_ttl=token_ttl, auto_renew=True)
-        logger.debug('Sync client initialized')
-
-        self.device_id = self.ensure_client_registered()
-        logger.info(f'Client registered, id: {self.device_id}')
+        self.token_ttl = token_ttl
+        self.credentials = CredentialCache(self.sync_dir/'credentials.json')
+        self._fxa_session = None
+        self._sync_client = None
+        self._sync_client_expires = 0
+        self.sync_client = RenewingSyncClient(self)
+        self._decrypt_pool = None
+        self._client_lock = threading.Lock()
+        self._local = threading.local()
+        self._sync_file_lock = threading.Lock()
+        # each local target (history, bookmarks file, sessions) is written
+        # by one pipeline at a time
+        self.histdb_lock = threading.Lock()
 
         self.params = {
             'full': True,
             'decrypt': True,
         }
         self.send_qute_commands = send_qute_commands
-        self.histdb = sqlite3.connect(QUTEBROSER_DATA_DIR/'history.sqlite')
+        self.qute_ipc = QuteIPC(
+            fifo=userscript.fifo if userscript is not None else None)
+        self.histdb = sqlite3.connect(QUTEBROSER_DATA_DIR/'history.sqlite',
+                                      check_same_thread=False)
+        self.mirror = Mirror(self.sync_dir/'mirror.sqlite')
+        self.bookmark_store = BookmarkStore(
+            QUTEBROSER_CONFIG_DIR/'bookmarks/urls')
+        self.server_collections = None
+        self.server_configuration = None
+        self.collection_keys = None
+
+        self.device_id = self.ensure_client_registered()
+        logger.info(f'Client registered, id: {self.device_id}')
+
+    @property
+    def fxa_session(self):
+        # only needed when the cached credentials are missing or expired
+        if self._fxa_session is None:
+            with self.metrics.phase('auth'):
+                self._fxa_session = client.get_fxa_session(self.login)
+            self.transport.adopt(self._fxa_session.apiclient)
+            logger.debug('FXA session obtained')
+        return self._fxa_session
+
+    @property
+    def current_sync_client(self):
+        with self._client_lock:
+            if self._sync_client is None or \
+                    self._sync_client_expires - TOKEN_MARGIN < time.time():
+                self._sync_client = InstrumentedSyncClient(
+                    self._create_sync_client(), self.metrics)
+            sync_client = self._sync_client
+        if threading.current_thread() is threading.main_thread():
+            return sync_client
+        # syncclient keeps the last response in raw_resp, so other threads
+        # get their own shallow copy sharing the same credentials
+        if getattr(self._local, 'base', None) is not sync_client:
+            self._local.base = sync_client
+            self._local.sync_client = copy.copy(sync_client)
+        return self._local.sync_client
+
+    def drop_sync_client(self, rejected):
+        """
+        Forget the sync client `rejected` and its cached credentials, so
+        that the next request gets a new token. Does nothing if another
+        thread already did.
+        """
+        with self._client_lock:
+            if self._sync_client is rejected:
+                self.credentials.delete('hawk')
+                self._sync_client = None
+
+    @property
+    def decrypt_pool(self):
+        # one pool for the client's lifetime; no worker starts until a
+        # page large enough to need them is decrypted
+        with self._client_lock:
+            if self._decrypt_pool is None:
+                self._decrypt_pool = decrypt_pool()
+            return self._decrypt_pool
+
+    @timed('auth')
+    def _create_sync_client(self):
+        hawk = self.credentials.get('hawk', margin=TOKEN_MARGIN)
+        # a client built from bare credentials cannot encrypt or decrypt,
+        # so the collection keys must be cached as well
+        if hawk is not None and self.credentials.get('collection_keys'):
+            logger.debug('Using cached sync credentials')
+            self._sync_client_expires = self.credentials.expiry('hawk')
+            return client.SyncClient(**hawk)
+
+        # get an OAuth access token...
+        access_token = self.credentials.get('oauth_token',
+                                            margin=TOKEN_MARGIN)
+        if access_token is None:
+            access_token, _ = client.create_oauth_token(
+                self.fxa_session, self.client_id, token_ttl=self.token_ttl,
+                with_refresh=False)
+            self.credentials.set('oauth_token', access_token,
+                                 expires=time.time() + self.token_ttl)
+            logger.debug('Access token obtained')
+
+        # create an authorized sync client...
+        requested = time.time()
+        with self.transport.capture(TOKENSERVER_PATH) as responses:
+            sync_client = client.get_sync_client(
+                self.fxa_session, self.client_id, access_token,
+                token_ttl=self.token_ttl, auto_renew=True)
+        self._sync_client_expires = requested + self._token_duration(
+            responses)
+        self.credentials.set('hawk', {
+            'uid': sync_client.user_id,
+            'api_endpoint': sync_client.api_endpoint,
+            'hashalg': sync_client.auth.credentials['algorithm'],
+            'id': sync_client.auth.credentials['id'],
+            'key': sync_client.auth.credentials['key'],
+        }, expires=self._sync_client_expires)
+        logger.debug('Sync client initialized')
+        return sync_client
+
+    def _token_duration(self, responses):
+        # syncclient does not tell how long the tokenserver let the token
+        # last, which may be less than we asked for
+        for response in reversed(responses):
+            try:
+                duration = response.json().get('duration')
+            except ValueError:
+                continue
+            if duration:
+                return min(duration, self.token_ttl)
+        return self.token_ttl
 
     def init_sync_file(self):
         directory = Path(os.environ.get("XDG_DATA_HOME"))/'qutefox-sync'
@@ -98,75 +308,613 @@ class QuteFoxClient():
         else:
             Path.touch(sync_file)
         # TODO add checks that last_sync is well-formed
+        self.sync_dir = directory
         self.sync_file = sync_file
         self.last_sync = last_sync
 
     def update_sync_file(self, key, val):
-        if self.last_sync is None:
-            self.last_sync = {}
-        self.last_sync[key] = val
-        logger.debug(f'Writing sync file at {self.sync_file}')
-        with open(self.sync_file, 'w') as f:
-            f.write(json.dumps(self.last_sync))
+        with self._sync_file_lock:
+            if self.last_sync is None:
+                self.last_sync = {}
+            self.last_sync[key] = val
+            logger.debug(f'Writing sync file at {self.sync_file}')
+            with open(self.sync_file, 'w') as f:
+                f.write(json.dumps(self.last_sync))
 
-    def upload_qute_history(self):
-        lastsynctime = self.last_sync.get('history_upsync_time', 0)
-        entries = {}
-        with self.histdb as db:
-            for row in db.execute(
-                    'SELECT * FROM History WHERE atime > %d;'
-                    % int(lastsynctime)):
-                entry = entries.get(row[0], {})
-                url = row[0]
-                entry['url'] = url
-                entry['title'] = row[1]
+    def get_server_collections(self, refresh=False):
+        """
+        Return the info/collections mapping of collection names to their
+        last-modified time. It is only requested once per run unless
+        `refresh` is set.
+        """
+        if self.server_collections is None or refresh:
+            cached = self.last_sync.get('info_collections')
+            headers = {}
+            if cached:
+                headers['X-If-Modified-Since'] = cached['modified']
+            try:
+                collections = _as_json(
+                    self.sync_client.info_collections(headers=headers))
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 304:
+                    raise
+                logger.debug('No changes on the server since last sync')
+                collections = cached['collections']
+            else:
+                self.update_sync_file('info_collections', {
+                    'modified': self.sync_client.raw_resp.headers.get(
+                        'X-Last-Modified'),
+                    'collections': collections})
+            self.server_collections = collections
+        return self.server_collections
+
+    def collection_unchanged(self, collection, key):
+        """
+        Whether `collection` is unchanged on the server since the timestamp
+        stored in sync-info under `key`.
+        """
+        modified = self.get_server_collections().get(collection)
+        return modified is not None and modified == self.last_sync.get(key)
+
+    def get_server_configuration(self):
+        """
+        Return the server limits from info/configuration, or an empty dict
+        if the server does not expose them.
+        """
+        if self.server_configuration is None:
+            try:
+                self.server_configuration = _as_json(
+                    self.sync_client._request('get', '/info/configuration'))
+            except requests.exceptions.HTTPError as e:
+                logger.warning(f'Cannot read server configuration: {e}')
+                self.server_configuration = {}
+        return self.server_configuration
+
+    def get_uploader(self, collection):
+        encrypt = None
+        if self.get_collection_keys() is not None:
+            def encrypt(record):
+                return self.encrypt_record(collection, record)
+        # the records were merged against the mirror, so the upload must
+        # fail if the collection changed on the server since
+        return BatchUploader(self.sync_client, collection,
+                             self.get_server_configuration(),
+                             encrypt=encrypt,
+                             unmodified_since=self.mirror.last_modified(
+                                 collection) or None)
+
+    def get_collection_keys(self):
+        """
+        Return the decrypted crypto/keys record, or None if kB is not
+        available and decryption must be left to syncclient.
+        """
+        if self.collection_keys is None:
+            crypto_modified = self.get_server_collections().get('crypto')
+            cached = self.credentials.get('collection_keys')
+            if cached and cached['modified'] == crypto_modified:
+                self.collection_keys = CollectionKeys(cached['payload'])
+                return self.collection_keys
+            keys = getattr(self.fxa_session, 'keys', None)
+            if not keys:
+                logger.debug('kB not available, decrypting with syncclient')
+                self.credentials.delete('collection_keys')
+                self.collection_keys = False
+                return None
+            kb = keys[1]
+            if isinstance(kb, str):
+                kb = bytes.fromhex(kb)
+            crypto_keys = _as_json(self.sync_client.get_record(
+                'crypto', 'keys'))
+            self.collection_keys = CollectionKeys(json.loads(decrypt_payload(
+                crypto_keys['payload'], KeyBundle.from_kb(kb))))
+            self.credentials.set('collection_keys', {
+                'payload': self.collection_keys.payload,
+                'modified': crypto_modified})
+        return self.collection_keys or None
+
+    def encrypt_record(self, collection, record):
+        """Return the BSO for `record` with its payload encrypted."""
+        bundle = self.get_collection_keys().for_collection(collection)
+        with self.metrics.phase('encrypt'):
+            return {'id': record['id'],
+                    'payload': encrypt_payload(json.dumps(record), bundle)}
+
+    def post_record(self, collection, record, ttl=None):
+        kwargs = {} if ttl is None else {'ttl': ttl}
+        self.metrics.incr('records_uploaded', collection=collection)
+        if self.get_collection_keys() is None:
+            return self.sync_client.post_record(
+                collection, record, encrypt=True, **kwargs)
+        bso = dict(self.encrypt_record(collection, record), **kwargs)
+        return self.sync_client.post_records(collection, [bso],
+                                             encrypt=False)
+
+    def get_records(self, collection, **params):
+        """
+        Fetch and decrypt records of `collection`, decrypting in parallel
+        when the collection keys are known.
+        """
+        keys = self.get_collection_keys()
+        if keys is None:
+            records = self.sync_client.get_records(
+                collection, parse_data=True, **dict(params, decrypt=True))
+            self.metrics.incr('records_fetched', len(records),
+                              collection=collection)
+            return records
+        bsos = self.sync_client.get_records(
+            collection, parse_data=True, **dict(params, decrypt=False))
+        self.metrics.incr('records_fetched', len(bsos),
+                          collection=collection)
+        with self.metrics.phase('decrypt'):
+            records = decrypt_records(bsos, keys.for_collection(collection),
+                                      pool=self.decrypt_pool)
+        self.metrics.incr('records_decrypted', len(records),
+                          collection=collection)
+        return records
+
+    def iter_records(self, collection, page_size=PAGE_SIZE,
+                     modified_since=None, offset=None,
+                     unmodified_since=None, **params):
+        """
+        Yield the decrypted records of `collection` one page at a time,
+        following X-Weave-Next-Offset, so that only one page is held in
+        memory. If `modified_since` is given and the collection did not
+        change after it, the server answers 304 and nothing is yielded.
+
+        An interrupted listing is resumed by passing the X-Weave-Next-Offset
+        and X-Last-Modified of its last page as `offset` and
+        `unmodified_since`.
+        """
+        params = dict(params, limit=page_size)
+        headers = {}
+        if offset is not None:
+            params['offset'] = offset
+            headers['X-If-Unmodified-Since'] = str(unmodified_since)
+        elif modified_since is not None:
+            headers['X-If-Modified-Since'] = str(modified_since)
+        while True:
+            try:
+                page = self.get_records(collection, headers=headers,
+                                        **params)
+            except requests.exceptions.HTTPError as e:
+                # only the first request is conditional on modification
+                if 'X-If-Modified-Since' not in headers or \
+                        e.response is None or e.response.status_code != 304:
+                    raise
+                return
+            response_headers = self.sync_client.raw_resp.headers
+            yield page
+            offset = response_headers.get('X-Weave-Next-Offset')
+            if not offset:
+                break
+            params['offset'] = offset
+            # fail with 412 rather than mixing pages from before and after
+            # a concurrent change to the collection
+            headers = {'X-If-Unmodified-Since':
+                       response_headers['X-Last-Modified']}
+
+    def refresh_collection(self, collection, force=False):
+        """
+        Bring the local mirror of `collection` up to date with the server,
+        downloading only the records modified since the last refresh.
+        Records of EXPIRING_COLLECTIONS the server no longer has are
+        removed. Return True if the mirror changed.
+        """
+        removed = 0
+        if collection in EXPIRING_COLLECTIONS and not force and \
+                self.mirror.last_modified(collection):
+            removed = self._drop_expired(collection)
+        return self._download_collection(collection, force) or removed > 0
+
+    def _drop_expired(self, collection):
+        # an ids-only listing is enough to find them
+        ids = _as_json(self.sync_client.get_records(collection, full=False))
+        removed = self.mirror.retain(collection, ids)
+        if removed:
+            logger.info(f'Removed {removed} expired {collection} records '
+                        'from the mirror')
+        return removed
+
+    def _download_collection(self, collection, force=False):
+        if force:
+            self.mirror.clear(collection)
+        server_modified = self.get_server_collections().get(collection)
+        if not self.mirror.is_stale(collection, server_modified):
+            logger.debug(f'Mirror of {collection} is up to date')
+            return False
+        if server_modified is None:
+            # the collection does not exist (yet) on the server
+            self.mirror.set_modified(collection, 0)
+            return False
+        params = dict(self.params, sort='oldest')
+        newer = self.mirror.last_modified(collection)
+        if newer is not None:
+            params['newer'] = newer
+        # pages already in the mirror are not downloaded again after an
+        # interruption, as long as the collection did not change since
+        checkpoint_key = f'{collection}_download_checkpoint'
+        checkpoint = self.last_sync.get(checkpoint_key)
+        resume = {}
+        if checkpoint and checkpoint['newer'] == newer and not force:
+            logger.info(f'Resuming download of {collection}')
+            resume = {'offset': checkpoint['offset'],
+                      'unmodified_since': checkpoint['modified']}
+        progress = Progress(f'Downloading {collection}', None)
+        pages = 0
+        try:
+            for page in self.iter_records(collection, modified_since=newer,
+                                          **resume, **params):
+                with self.metrics.phase('sqlite'):
+                    self.mirror.add(collection, page)
+                self.metrics.incr('rows_written', len(page),
+                                  target='mirror')
+                pages += 1
+                progress.update(len(page))
+                headers = self.sync_client.raw_resp.headers
+                if headers.get('X-Weave-Next-Offset'):
+                    self.update_sync_file(checkpoint_key, {
+                        'newer': newer,
+                        'offset': headers['X-Weave-Next-Offset'],
+                        'modified': headers['X-Last-Modified']})
+        except requests.exceptions.HTTPError as e:
+            if not resume or e.response is None or \
+                    e.response.status_code != 412:
+                raise
+            logger.warning(f'{collection} changed since the interrupted '
+                           'download, starting over')
+            self.update_sync_file(checkpoint_key, None)
+            return self._download_collection(collection)
+        if self.last_sync.get(checkpoint_key):
+            self.update_sync_file(checkpoint_key, None)
+        if not pages:
+            logger.debug(f'{collection} not modified since {newer}')
+            return False
+        # the collection is only marked as up to date once all pages are in
+        modified = float(self.sync_client.raw_resp.headers.get(
+            'X-Last-Modified', server_modified))
+        self.mirror.set_modified(collection, modified)
+        logger.info(f'Mirrored {progress.done} new {collection} records')
+        return True
+
+    def get_collection(self, collection, newer=None):
+        """
+        Return the parsed payloads of all records in `collection`, read
+        from the local mirror after refreshing it.
+        """
+        self.refresh_collection(collection)
+        return list(self.mirror.records(collection, newer=newer))
+
+    def _history_max_rowid(self):
+        return self.histdb.execute(
+            'SELECT coalesce(max(rowid), 0) FROM History;').fetchone()[0]
+
+    def _stage_qute_history(self, after_rowid, until_rowid, since=None,
+                            exclude=()):
+        """
+        Copy the visits added in the rowid range (after_rowid, until_rowid]
+        to the temporary table HistoryExport, indexed by url, so that they
+        can be read in chunks without keeping History locked in between.
+        `since` additionally filters on visit time, for profiles synced
+        before rowids were tracked, and the (after, until] rowid ranges in
+        `exclude` are left out. Return the number of urls staged.
+        """
+        db = self.histdb
+        query = ('CREATE TEMP TABLE HistoryExport AS '
+                 'SELECT url, title, atime, redirect FROM History '
+                 'WHERE rowid > ? AND rowid <= ?')
+        params = [after_rowid, until_rowid]
+        if since is not None:
+            query += ' AND atime > ?'
+            params.append(int(since))
+        for excluded in exclude:
+            query += ' AND NOT (rowid > ? AND rowid <= ?)'
+            params.extend(excluded)
+        db.execute('DROP TABLE IF EXISTS temp.HistoryExport;')
+        db.execute(query + ';', params)
+        db.execute('CREATE INDEX temp.HistoryExportUrl '
+                   'ON HistoryExport (url);')
+        return db.execute('SELECT count(DISTINCT url) '
+                          'FROM HistoryExport;').fetchone()[0]
+
+    def _read_qute_history(self, after_url, limit):
+        """
+        Return (url, title, visits) for the first `limit` urls after
+        `after_url` staged by _stage_qute_history, in url order.
+        """
+        cursor = self.histdb.execute(
+            'SELECT url, title, atime, redirect FROM HistoryExport '
+            'WHERE url IN (SELECT DISTINCT url FROM HistoryExport '
+            'WHERE url > ? ORDER BY url LIMIT ?) ORDER BY url;',
+            (after_url, limit))
+        history = []
+        for url, rows in itertools.groupby(cursor, key=lambda row: row[0]):
+            title = ''
+            visits = []
+            for _, row_title, atime, redirect in rows:
+                title = row_title or title
                 # we must multiply atime by 1000000 because firefox
                 # uses 16-digit timestamps (microseconds) whereas
                 # qutebrowser uses 10-digit timestamps (seconds)
-                entry['visits'] = entry.get('visits', []) + \
-                    [{'date': int(row[2]) * 10**6,
-                      'type': 1 if row[3] == 0 else 6}]
-                entries[url] = entry
-        hist_res = self.sync_client.get_records(
-            'history', parse_data=True, **self.params)
-        hist_res = [json.loads(bso['payload']) for bso in hist_res]
-        ff_hist_dict = {bso.get('histUri'): bso for bso in hist_res}
-        bso_list = []
-        for url in entries:
-            qute_history_dict = entries[url]
-            qute_visits = qute_history_dict['visits']
-            bso = ff_hist_dict.get(url)
-            if bso is not None and bso.get('visits') is not None:
-                bso['visits'] += [v for v in qute_visits
-                                  if v not in bso['visits']]
-            else:
+                visits.append({'date': int(atime) * 10**6,
+                               'type': 1 if redirect == 0 else 6})
+            history.append((url, title, visits))
+        return history
+
+    @timed('upload_qute_history')
+    def upload_qute_history(self):
+        """
+        Return False if the upload was aborted because history changed on
+        the server since it was last refreshed.
+        """
+        with self.histdb_lock:
+            try:
+                self._upload_qute_history()
+            except PreconditionFailed as e:
+                logger.error(f'History upload aborted: {e}')
+                return False
+        return True
+
+    def _upload_qute_history(self):
+        # History only grows by appending, so the rowid of the last visit
+        # uploaded marks exactly what is new, unlike visit times which
+        # depend on the clock
+        last_rowid = self.last_sync.get('history_upsync_rowid')
+        since = None
+        if last_rowid is None:
+            last_rowid = 0
+            since = self.last_sync.get('history_upsync_time')
+        max_rowid = self._history_max_rowid()
+        if max_rowid < last_rowid:
+            logger.warning('qutebrowser history was cleared, uploading it '
+                           'all again')
+            last_rowid = 0
+            self.update_sync_file('history_imported_rowids', None)
+        # each chunk of urls is committed on its own and checkpointed, so
+        # that an interrupted upload finishes the same rowid range after
+        # the last committed url
+        after_url = ''
+        checkpoint = self.last_sync.get('history_export_checkpoint')
+        if checkpoint and checkpoint['after_rowid'] == last_rowid and \
+                checkpoint['until_rowid'] <= max_rowid:
+            logger.info('Resuming interrupted history upload')
+            max_rowid = checkpoint['until_rowid']
+            after_url = checkpoint['url']
+        # visits imported from Firefox need not be uploaded back
+        imported = self.last_sync.get('history_imported_rowids') or []
+        new_from = last_rowid
+        for after_rowid, until_rowid in sorted(imported):
+            if after_rowid <= new_from < until_rowid:
+                new_from = until_rowid
+        if new_from >= max_rowid:
+            logger.info('No new qutebrowser history')
+            self._finish_history_upload(max_rowid)
+            return
+        self.refresh_collection('history')
+        with self.metrics.phase('sqlite'):
+            total = self._stage_qute_history(last_rowid, max_rowid, since,
+                                             exclude=imported)
+        progress = Progress('Uploading history', total, unit='urls')
+        uploaded = 0
+        while True:
+            with self.metrics.phase('sqlite'):
+                history = self._read_qute_history(after_url, EXPORT_CHUNK)
+            if not history:
+                break
+            uploaded += self._upload_history_chunk(history)
+            after_url = history[-1][0]
+            self.update_sync_file('history_export_checkpoint', {
+                'after_rowid': last_rowid, 'until_rowid': max_rowid,
+                'url': after_url})
+            progress.update(len(history))
+        self.histdb.execute('DROP TABLE IF EXISTS temp.HistoryExport;')
+        self._finish_history_upload(max_rowid)
+        logger.info(f'Uploaded {uploaded} history records')
+
+    def _finish_history_upload(self, max_rowid):
+        """Mark the visits up to rowid `max_rowid` as uploaded."""
+        if self.last_sync.get('history_upsync_rowid') != max_rowid:
+            self.update_sync_file('history_upsync_rowid', max_rowid)
+        if self.last_sync.get('history_export_checkpoint'):
+            self.update_sync_file('history_export_checkpoint', None)
+        imported = self.last_sync.get('history_imported_rowids')
+        if imported:
+            self.update_sync_file('history_imported_rowids', [
+                r for r in imported if r[1] > max_rowid] or None)
+
+    def _upload_history_chunk(self, history):
+        """
+        Upload the (url, title, visits) in `history` in one batch, and
+        store the uploaded records in the mirror. Return the number of
+        records uploaded.
+        """
+        uploader = self.get_uploader('history')
+        records = {}
+        for url, title, qute_visits in history:
+            with self.metrics.phase('sqlite'):
+                bso = self.mirror.find_history(url)
+            if bso is None:
                 # create BSO from scratch
                 # TODO test if my own generated IDs correspond to FF's
                 bso = {
                     'id': hashlib.sha1(url.encode('utf-8')).hexdigest()[:10],
-                    'histUri': qute_history_dict['url'],
-                    'title': qute_history_dict['title'],
-                    'visits': qute_visits
+                    'histUri': url,
+                    'title': title,
+                    'visits': []
                 }
-            bso['visits'].sort(key=lambda d: d.get('date'), reverse=True)
-            bso_list.append(bso)
-        with open('h.json', 'w') as f:
-            f.write(json.dumps(bso_list))
-        res = self.sync_client.post_records('history', bso_list, encrypt=True)
-        __import__('pudb').set_trace()
-        self.update_sync_file('history_upsync_time', time.time())
-
-    def download_ff_history(self):
-        hist_res = self.sync_client.get_records(
-            'history', parse_data=True, **self.params)
-        lastsynctime = self.last_sync.get('history_dsync_time', 0)
+            ff_visits = bso.get('visits') or []
+            # visits imported from Firefox come back truncated to the
+            # second and with their type reduced to 1 or 6, so only the
+            # second identifies them
+            seen = {(v.get('date') or 0) // 10**6 for v in ff_visits}
+            new_visits = []
+            for visit in qute_visits:
+                second = visit['date'] // 10**6
+                if second not in seen:
+                    seen.add(second)
+                    new_visits.append(visit)
+            if not new_visits:
+                continue
+            visits = sorted(ff_visits + new_visits, key=_visit_date,
+                            reverse=True)[:FF_MAX_VISITS]
+            # visits older than those Firefox keeps change nothing
+            if visits == sorted(ff_visits, key=_visit_date,
+                                reverse=True)[:FF_MAX_VISITS]:
+                continue
+            bso['visits'] = visits
+            uploader.add(bso)
+            records[bso['id']] = bso
+        if not records:
+            return 0
+        res = uploader.commit()
+        if res['failed']:
+            # the server rejects a record for what it holds (too large,
+            # invalid), so retrying it would only stall the uploads after
+            failed = [f'{records[i]["histUri"] if i in records else i} '
+                      f'({reason})' for i, reason in res['failed'].items()]
+            logger.error(f'{len(failed)} history records failed to upload, '
+                         'skipping them: ' + ', '.join(failed[:10]))
+            self.metrics.incr('records_failed', len(res['failed']),
+                              collection='history')
+        if not res['success']:
+            return 0
+        self.metrics.incr('records_uploaded', len(res['success']),
+                          collection='history')
+        # keep the mirror in step with the server, as the next chunk is only
+        # accepted if nothing changed since this one
+        self.mirror.add('history', (
+            {'id': i, 'modified': res['modified'],
+             'payload': json.dumps(records[i])}
+            for i in res['success'] if i in records))
+        if uploader.unmodified_since is not None:
+            # the upload was conditional, so the server holds exactly the
+            # mirror plus our records
+            self.mirror.set_modified('history', res['modified'])
+        return len(res['success'])
+
+    @timed('sqlite')
+    def _import_history(self, rows):
+        """
+        Insert (url, title, atime, redirect) rows into qutebrowser's history
+        in one transaction, skipping visits that are already there, and
+        update CompletionHistory so they show up in :open completion.
+        Return the number of visits added and the rowid of the last one;
+        the visits added have the rowids just before it.
+        """
+        db = self.histdb
+        synchronous = db.execute('PRAGMA synchronous;').fetchone()[0]
+        journal_mode = db.execute('PRAGMA journal_mode;').fetchone()[0]
+        db.execute('PRAGMA synchronous = OFF;')
+        if journal_mode != 'wal':
+            db.execute('PRAGMA journal_mode = MEMORY;')
+        has_completion = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+            "AND name = 'CompletionHistory';").fetchone()
+        try:
+            with db:
+                db.execute('CREATE TEMP TABLE IF NOT EXISTS HistoryImport '
+                           '(url TEXT, title TEXT, atime INTEGER, '
+                           'redirect INTEGER);')
+                db.execute('DELETE FROM HistoryImport;')
+                db.executemany(
+                    'INSERT INTO HistoryImport VALUES (?, ?, ?, ?);', rows)
+                added = db.execute(
+                    'INSERT INTO History '
+                    "SELECT url, coalesce(max(title), ''), atime, "
+                    'max(redirect) '
+                    'FROM HistoryImport AS i WHERE NOT EXISTS '
+                    '(SELECT 1 FROM History AS h '
+                    'WHERE h.atime = i.atime AND h.url = i.url) '
+                    'GROUP BY url, atime;').rowcount
+                # nobody else can write until we commit
+                last_rowid = db.execute(
+                    'SELECT coalesce(max(rowid), 0) FROM History;'
+                ).fetchone()[0]
+                if has_completion:
+                    db.execute(
+                        'INSERT INTO CompletionHistory '
+                        '(url, title, last_atime) '
+                        "SELECT url, coalesce(title, ''), max(atime) "
+                        'FROM HistoryImport '
+                        'WHERE redirect = 0 GROUP BY url '
+                        'ON CONFLICT (url) DO UPDATE SET '
+                        'title = excluded.title, '
+                        'last_atime = excluded.last_atime '
+                        'WHERE excluded.last_atime > last_atime;')
+                db.execute('DELETE FROM HistoryImport;')
+        finally:
+            db.execute(f'PRAGMA synchronous = {synchronous};')
+            if journal_mode != 'wal':
+                db.execute(f'PRAGMA journal_mode = {journal_mode};')
+        return added, last_rowid
+
+    @timed('download_ff_history')
+    def download_ff_history(self, force=False):
+        """
+        Args:
+            force: ignore the stored high-water mark and download the whole
+                collection. This also happens on the first sync.
+        """
+        # the high-water mark is the server's X-Last-Modified, so it is not
+        # affected by the local clock
+        lastmodified = self.last_sync.get('history_dsync_modified')
+        if not force and self.collection_unchanged(
+                'history', 'history_dsync_modified'):
+            logger.info('Firefox history unchanged since last sync')
+            return
+        self.refresh_collection('history', force=force)
+        if lastmodified is None or force:
+            lastmodified = 0
+            logger.info('Importing full history collection')
+        else:
+            logger.info(f'Importing history modified after {lastmodified}')
+        # each chunk is committed on its own and checkpointed, so that an
+        # interrupted import resumes after the last committed chunk
+        checkpoint = self.last_sync.get('history_import_checkpoint')
+        after = None
+        if checkpoint and checkpoint['newer'] == lastmodified and not force:
+            logger.info('Resuming interrupted history import')
+            after = checkpoint['after']
+        progress = Progress('Importing history', self.mirror.count(
+            'history', newer=lastmodified, after=after))
+        added = 0
+        with self.histdb_lock:
+            for key, records in self.mirror.pages(
+                    'history', IMPORT_CHUNK, newer=lastmodified, after=after):
+                chunk_added, last_rowid = self._import_history(
+                    self._history_rows(records))
+                added += chunk_added
+                if chunk_added:
+                    self._exclude_from_upload(last_rowid - chunk_added,
+                                              last_rowid)
+                self.update_sync_file('history_import_checkpoint',
+                                      {'newer': lastmodified, 'after': key})
+                progress.update(len(records))
+        self.metrics.incr('rows_written', added, target='history')
+        logger.info(f"Added {added} entries to qutebrowser history")
+        # only advance the mark once the inserts above have been committed
+        self.update_sync_file('history_dsync_modified',
+                              self.mirror.last_modified('history'))
+        self.update_sync_file('history_import_checkpoint', None)
+
+    def _exclude_from_upload(self, after_rowid, until_rowid):
+        """
+        Keep the visits in the rowid range (after_rowid, until_rowid],
+        which came from Firefox, out of the next history upload.
+        """
+        ranges = list(self.last_sync.get('history_imported_rowids') or [])
+        if ranges and ranges[-1][1] == after_rowid:
+            ranges[-1] = [ranges[-1][0], until_rowid]
+        else:
+            ranges.append([after_rowid, until_rowid])
+        self.update_sync_file('history_imported_rowids', ranges)
+
+    def _history_rows(self, bsos):
+        """
+        Yield qutebrowser History rows for the visits in the given Firefox
+        history records.
+        """
         # FIXME find out what type means
-        tosync = []
-        for record in hist_res:
-            if record.get('modified', -1) > lastsynctime:
-                tosync.append(json.loads(record.get('payload')))
-        db_records = []
-        for bso in tosync:
+        for bso in bsos:
             # visit types:
             # 1: A link was followed.
             # 2: The URL was typed by the user.
@@ -178,38 +926,31 @@ class QuteFoxClient():
             # 8: User follows a link that was in a frame.
             if bso.get('histUri') is None:
                 continue
-            visits = [i for i in bso.get('visits', [])
+            # Firefox sends "title": null for pages without one
+            title = bso.get('title') or ''
+            visits = [i for i in bso.get('visits') or []
                       if i.get('type') not in [4, 7, 8]
-                      and int(i.get('date')) > lastsynctime]
+                      and i.get('date') is not None]
             for visit in visits:
                 # Note: we truncate the date because
                 # FF sync uses microsecond (16-digit) timestamps
                 # and qutebrowser uses second (10-digit) timestamps
-                db_records.append(
-                    (bso.get('histUri'),
-                     bso.get('title', ''),
-                     visit.get('date') // 1000000,
-                     int(visit.get('type') in [5, 6])))
-        with self.histdb as db:
-            for record in db_records:
-                db.execute('INSERT INTO History VALUES (?, ?, ?, ?);', record)
-        logger.info(f"Added {len(db_records)} entries to qutebrowser history")
-        self.update_sync_file('history_dsync_time', time.time())
+                yield (bso.get('histUri'),
+                       title,
+                       visit.get('date') // 1000000,
+                       int(visit.get('type') in [5, 6]))
 
     def ensure_client_registered(self):
         client_name = 'qutesyncclient'  # FIXME magic string
 
-        devices = self.fxa_session.apiclient.get("/account/devices",
-                                                 auth=self.fxa_session._auth)
-        my_device = None
-
-        for fxa_device in devices:
-            if fxa_device['isCurrentDevice']:
-                my_device = fxa_device
-
-        device_id = "29a686c482ca7389604ac02aeb0fc7b3"
-        device_id = my_device.get('id')
-        # device_id = client.read_session_cache()['uid']
+        # re-registering is skipped while the record we posted is unchanged
+        # and far enough from expiry
+        registered = self.credentials.get('client_record',
+                                          margin=CLIENT_RECORD_MARGIN)
+        if registered is not None:
+            device_id = registered['id']
+        else:
+            device_id = self._get_device_id()
 
         bso = {
             'id': device_id,
@@ -220,24 +961,58 @@ class QuteFoxClient():
             ],
             'type': 'desktop'
         }
+        digest = _digest(bso)
+        if registered is not None and registered['hash'] == digest:
+            logger.debug('Client record up to date')
+            return device_id
 
-        self.sync_client.post_record('clients', bso, encrypt=True, ttl=1814400)
+        self.post_record('clients', bso, ttl=CLIENT_RECORD_TTL)
+        self.credentials.set('client_record',
+                             {'id': device_id, 'hash': digest},
+                             expires=time.time() + CLIENT_RECORD_TTL)
 
         return device_id
 
+    def _get_device_id(self):
+        devices = self.fxa_session.apiclient.get("/account/devices",
+                                                 auth=self.fxa_session._auth)
+        my_device = None
+
+        for fxa_device in devices:
+            if fxa_device['isCurrentDevice']:
+                my_device = fxa_device
+
+        # device_id = client.read_session_cache()['uid']
+        return my_device.get('id')
+
     def _get_firefox_tabs(self):
-        return self.sync_client.get_records('tabs', parse_data=True,
-                                            **self.params)
+        # refreshed by create_qutebrowser_sessions
+        return list(self.mirror.records('tabs'))
 
+    @timed('create_qutebrowser_sessions')
     def create_qutebrowser_sessions(self):
+        changed = self.refresh_collection('tabs')
+        if not changed and \
+                self.collection_unchanged('tabs', 'tabs_dsync_modified'):
+            logger.info('Firefox tabs unchanged since last sync')
+            return []
         outer_json = self._get_firefox_tabs()
         logger.info('Obtained tab list from firefox')
         session_name_list = []
-        for payload in outer_json:
-            inner_json = json.loads(payload['payload'])
+        written = []
+        # updated on a copy: update_sync_file serializes last_sync under its
+        # lock while other pipelines may be writing it
+        session_hashes = dict(self.last_sync.get('session_hashes', {}))
+        for inner_json in outer_json:
             if inner_json['id'] == self.device_id:
                 continue
             client_name = inner_json['clientName']
+            session_name_list.append(client_name)
+            session_path = QUTEBROSER_DATA_DIR/f'sessions/{client_name}.yml'
+            digest = _digest(inner_json['tabs'])
+            if session_hashes.get(client_name) == digest and \
+                    session_path.is_file():
+                continue
             tablist = []
             for jsontab in inner_json['tabs']:
                 tab = {}
@@ -269,32 +1044,40 @@ class QuteFoxClient():
                     'tree': tabtree
                 }]
             }
-            session_path = QUTEBROSER_DATA_DIR/f'sessions/{client_name}.yml'
-            with open(session_path, 'w') as session_file:
-                yaml.dump(session, session_file, default_flow_style=False)
-            session_name_list.append(client_name)
-        logger.info('Created qutebrowser sessions: ' +
-                    ', '.join([f'"{s}"' for s in session_name_list]))
+            with self.metrics.phase('yaml'), \
+                    open(session_path, 'w') as session_file:
+                yaml.dump(session, session_file, Dumper=YamlDumper,
+                          default_flow_style=False)
+            self.metrics.incr('rows_written', target='sessions')
+            session_hashes[client_name] = digest
+            written.append(client_name)
+        if written:
+            logger.info('Created qutebrowser sessions: ' +
+                        ', '.join([f'"{s}"' for s in written]))
+            self.update_sync_file('session_hashes', session_hashes)
+        else:
+            logger.info('All qutebrowser sessions up to date')
+        self.update_sync_file('tabs_dsync_modified',
+                              self.mirror.last_modified('tabs'))
+        return session_name_list
 
+    @timed('update_ff_session')
     def update_ff_session(self, session_name=None):
         if session_name:
             qsess = QUTEBROSER_DATA_DIR/f'sessions/{session_name}.yml'
         elif userscript is not None or self.send_qute_commands:
-            if userscript is not None:
-                # simple hack to get current session: force qutebrowser to
-                # save it then upload the most recently written session file
-                userscript.run_command('session-save')
-            elif self.send_qute_commands:
-                self.qutebrowser_command(':session-save')
-            session_list = [(f.stat().st_mtime, f)
-                            for f in (qsess.data_dir/'sessions').iterdir()]
-            qsess = session_list.sort(lambda x: x[0])[-1]
+            # simple hack to get current session: force qutebrowser to
+            # save it then upload the most recently written session file
+            qsess = self._save_current_session()
+            if qsess is None:
+                logger.error('qutebrowser did not save its session, not '
+                             'uploading tabs')
+                return
         else:
             qsess = QUTEBROSER_DATA_DIR/'sessions/default.yml'
         logger.info('Uploading qutebrowser session ' + qsess.name)
-        with open(qsess) as qsess:
-            qsess_yaml = qsess.read()
-            qute_session = yaml.safe_load(qsess_yaml)
+        with self.metrics.phase('yaml'), open(qsess) as qsess:
+            qute_session = yaml.load(qsess, Loader=YamlLoader)
 
         tabs = []
         for window in qute_session['windows']:
@@ -321,59 +1104,150 @@ class QuteFoxClient():
             'clientName': CLIENT_NAME,
             'tabs': tabs
         }
-        self.sync_client.post_record(
-            'tabs', tab_object, encrypt=True)
+        digest = _digest(tab_object)
+        last_upload = self.last_sync.get('tabs_upload', {})
+        if last_upload.get('hash') == digest and \
+                last_upload.get('time', 0) + TABS_TTL \
+                - CLIENT_RECORD_MARGIN > time.time():
+            logger.info('Tabs unchanged since last upload')
+            return
+        self.post_record('tabs', tab_object, ttl=TABS_TTL)
+        self.update_sync_file('tabs_upload',
+                              {'hash': digest, 'time': time.time()})
         logger.debug('Session record posted to SyncServer')
 
-    def reload_qutebrowser_bookmarks(self):
+    def sync_all(self, one_way_dest=None, upload_bookmark_args={},
+                 download_bookmark_args={}, force=False):
+        """
+        Run the tabs, bookmarks and history pipelines concurrently, sharing
+        this client. Each pipeline is the only writer of its local target.
+        """
+        to_qute = one_way_dest in (None, 'qutebrowser')
+        to_ff = one_way_dest in (None, 'firefox')
+
+        def tabs():
+            if to_qute:
+                self.create_qutebrowser_sessions()
+            if to_ff:
+                self.update_ff_session()
+
+        def bookmarks():
+            if to_ff:
+                self.upload_qute_bookmarks(**upload_bookmark_args)
+            if to_qute and download_bookmark_args:
+                self.download_ff_bookmarks(**download_bookmark_args)
+
+        def history():
+            if to_qute:
+                self.download_ff_history(force=force)
+            if to_ff:
+                self.upload_qute_history()
+
+        # shared state is fetched once before the pipelines start
+        self.get_server_collections()
+        self.get_collection_keys()
+        self.get_server_configuration()
+        pipelines = [tabs, bookmarks, history]
+        with ThreadPoolExecutor(len(pipelines)) as pool:
+            futures = [pool.submit(p) for p in pipelines]
+        for pipeline, future in zip(pipelines, futures):
+            if future.exception() is not None:
+                logger.error(f'{pipeline.__name__} sync failed',
+                             exc_info=future.exception())
+
+    def reload_qutebrowser_bookmarks(self, added=None, removed=None):
+        """
+        Make qutebrowser pick up changes to the bookmarks file. If the
+        (url, title) pairs added and urls removed are given, only those are
+        applied, which is much faster than reparsing a large file.
+        """
         reload_filename = Path(__file__).parent/'util/bookmark_reload.py'
-        self.qutebrowser_command(f':debug-pyeval --file {reload_filename}')
+        added = added or []
+        removed = removed or []
+        if not (added or removed) or \
+                len(added) + len(removed) > BOOKMARK_DELTA_MAX:
+            self.qutebrowser_command(
+                f':debug-pyeval --file {reload_filename}')
+            return
+        delta = json.dumps({'added': added, 'removed': removed})
+        template = Path(__file__).parent/'util/bookmark_delta.py'
+        delta_filename = self.sync_dir/'bookmark_delta.py'
+        delta_filename.write_text(
+            'import json\n'
+            f'delta = json.loads({delta!r})\n'
+            f'full_reload = {str(reload_filename)!r}\n'
+            + template.read_text())
+        self.qutebrowser_command(f':debug-pyeval --file {delta_filename}')
+
+    def _save_current_session(self):
+        """
+        Make qutebrowser save its session and return the file it wrote, or
+        None if the save could not be confirmed.
+        """
+        before = self._own_session_mtimes()
+        if not self.qutebrowser_command(':session-save'):
+            return None
+        # the command runs asynchronously in qutebrowser
+        deadline = time.monotonic() + SESSION_SAVE_TIMEOUT
+        while True:
+            saved = [(mtime, path) for path, mtime
+                     in self._own_session_mtimes().items()
+                     if before.get(path) != mtime]
+            if saved:
+                return max(saved)[1]
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0.1)
+
+    def _own_session_mtimes(self):
+        """
+        Return the modification times of the session files, leaving out
+        those we write for remote Firefox clients.
+        """
+        remote = set(self.last_sync.get('session_hashes', {}))
+        mtimes = {}
+        for path in (Path(QUTEBROSER_DATA_DIR)/'sessions').glob('*.yml'):
+            if path.stem in remote:
+                continue
+            try:
+                mtimes[path] = path.stat().st_mtime_ns
+            except FileNotFoundError:
+                # replaced while being saved
+                continue
+        return mtimes
 
-    def qutebrowser_command(self, command):
-        subprocess.run(['qutebrowser', f'{command}'])
+    def qutebrowser_command(self, *commands):
+        """Run one or more commands in the running qutebrowser."""
+        return self.qute_ipc.send(*commands)
 
+    @timed('download_ff_bookmarks')
     def download_ff_bookmarks(self, folder_id):
-        ff_bookmark_raw = self.sync_client.get_records(
-            'bookmarks', parse_data=True, **self.params)
-        ff_bookmark_response = [json.loads(bso.get('payload'))
-                                for bso in ff_bookmark_raw]
-        ff_folders = [bso for bso in ff_bookmark_response
-                      if bso.get('id') == folder_id]
-        if len(ff_folders) != 1:
-            if not ff_folders:
-                raise KeyError('Bookmark folder not found')
-            else:
-                logger.error(
-                    'Multiple matching folders found, critical sync error')
-        folder = ff_folders[0]
-        ff_bookmarks = []
-        for child_id in folder.get('children', []):
-            child = next(bso for bso in ff_bookmark_response
-                         if bso.get('id') == child_id)
-            if child.get('type') == 'bookmark':
-                if not child.get('bmkUri'):
-                    logger.warning(
-                        f'bmkUri not found for bookmark record {child_id}')
-                    continue
-                ff_bookmarks.append(
-                    (child.get('bmkUri'), child.get('title', '')))
-        logger.info(f'Gotten {len(ff_bookmarks)} Firefox bookmarks')
-        bookfile = QUTEBROSER_CONFIG_DIR/'bookmarks/urls'
-        qute_bookmarks = []
-        with open(bookfile) as f:
-            for line in f:
-                url, *title = line.split(' ')
-                title = ' '.join(title)
-                qute_bookmarks.append((url, title))
-        new_bookmark_lines = [' '.join(b) for b in ff_bookmarks
-                              if b not in qute_bookmarks]
-        logger.info(f'Updating {len(new_bookmark_lines)} bookmarks')
-        with open(bookfile, 'a') as f:
-            f.write('\n'.join(new_bookmark_lines))
-        logger.info('Reloading qutebrowser bookmarks (hacky, might not work)')
-        if self.send_qute_commands:
-            self.reload_qutebrowser_bookmarks()
+        if self.collection_unchanged('bookmarks', 'bookmark_dsync_modified'):
+            logger.info('Firefox bookmarks unchanged since last sync')
+            return
+        tree = BookmarkTree(self.get_collection('bookmarks'))
+        if folder_id not in tree:
+            raise KeyError('Bookmark folder not found')
+        delta = tree.diff(folder_id, self.bookmark_store.load())
+        # bookmarks missing from qutebrowser are "removed" from Firefox's
+        # point of view
+        added = self.bookmark_store.merge(
+            (record['bmkUri'], record.get('title', ''))
+            for record in delta.removed)
+        logger.info(f'Updating {len(added)} bookmarks')
+        if added:
+            self.bookmark_store.save()
+        self.metrics.incr('rows_written', len(added), target='bookmarks')
+        if added and self.send_qute_commands:
+            logger.info('Reloading qutebrowser bookmarks (hacky, might not '
+                        'work)')
+            self.reload_qutebrowser_bookmarks(
+                added=[(url, self.bookmark_store.bookmarks[url])
+                       for url in added])
+        self.update_sync_file('bookmark_dsync_modified',
+                              self.mirror.last_modified('bookmarks'))
 
+    @timed('upload_qute_bookmarks')
     def upload_qute_bookmarks(self,
                               parent={'id': 'menu', 'name': 'menu'},
                               force=False,
@@ -385,9 +1259,12 @@ class QuteFoxClient():
             parent: a dict with keys 'name' and 'id', directing where the
                 folder containing synced bookmarks will be created/updated.
 
+        Return False if the upload was aborted because bookmarks changed on
+        the server since they were last refreshed.
+
         """
-        bookfile = QUTEBROSER_CONFIG_DIR/'bookmarks/urls'
-        if not bookfile.is_file():
+        bookfile = self.bookmark_store.path
+        if not self.bookmark_store.exists():
             logger.error(f'Bookmark file {bookfile} not found, returning.')
             return
         if bookfile.stat().st_mtime < \
@@ -400,15 +1277,8 @@ class QuteFoxClient():
 
         # obtain existing bookmark records and check if a directory
         # already exists from previous sync. Store it in ff_folder_bso
-        ff_bookmark_response = self.sync_client.get_records(
-            'bookmarks', parse_data=True, **self.params)
-        ff_bookmarks = [json.loads(bso['payload'])
-                        for bso in ff_bookmark_response]
-        ff_bookmark_ids = [bso.get('id') for bso in ff_bookmarks]
-        folder_match = [bso for bso in ff_bookmarks
-                        if bso.get('type') == 'folder'
-                        and bso.get('title') == folder_name
-                        and bso.get('parentid') == parent['id']]
+        tree = BookmarkTree(self.get_collection('bookmarks'))
+        folder_match = tree.find_folders(folder_name, parent['id'])
         if len(folder_match) > 1:
             logger.warning(
                 f'Multiple directories with same name: {folder_name}')
@@ -418,7 +1288,7 @@ class QuteFoxClient():
             folder_match = [bso for bso in folder_match
                             if bso.get('id') == folder_id]
         if folder_match:
-            folder_bso = folder_match[0]
+            folder_bso = dict(folder_match[0])
             logger.info(
                 f'Found an existing folder record with id {folder_bso["id"]}')
         else:
@@ -432,53 +1302,46 @@ class QuteFoxClient():
             }
             logger.info(
                 f'Creating a new folder record with id {folder_bso["id"]}')
-        bookmarks = []
-        with open(bookfile) as f:
-            for line in f:
-                url, *title = line.split(' ')
-                title = ' '.join(title)
-                # qutebrowser enforces no url duplicates
-                # so we can obtain a unique ID from the (unique) url
-                bso = {
-                    'type': 'bookmark',
-                    'parentid': folder_bso['id'],
-                    'parentName': folder_bso['title'],
-                    'title': title,
-                    'bmkUri': url,
-                    'id': hashlib.sha1(url.encode('utf-8')).hexdigest()[:10],
-                    'loadInSidebar': False,
-                    'dateAdded': timenow,
-                    'tags': []
-                }
-                if bso['id'] not in folder_bso.get('children', []) \
-                        or bso['id'] not in ff_bookmark_ids:
-                    bookmarks.append(bso)
+        qute_bookmarks = self.bookmark_store.load()
+        delta = tree.diff(folder_bso['id'], qute_bookmarks)
+        if delta.moved:
+            logger.info(f'{len(delta.moved)} bookmarks already exist in '
+                        'other Firefox folders, not duplicating them')
+        bookmarks = [{
+            'type': 'bookmark',
+            'parentid': folder_bso['id'],
+            'parentName': folder_bso['title'],
+            'title': qute_bookmarks[url],
+            'bmkUri': url,
+            'id': bookmark_id(url),
+            'loadInSidebar': False,
+            'dateAdded': timenow,
+            'tags': []
+        } for url in delta.added]
         if not bookmarks:
             logger.info('All bookmarks up to date!')
             return
-        folder_bso['children'] = folder_bso.get('children', []) \
-            + [b['id'] for b in bookmarks
-               if b not in folder_bso.get('children', [])]
-
-        logger.info('Uploading folder')
-        response_str = self.sync_client.post_record(
-            'bookmarks', folder_bso, encrypt=True, params={'batch': 'true'})
-        response = json.loads(response_str)
-        if response['failed']:
-            print(response)
+        children = folder_bso.get('children', [])
+        known_children = set(children)
+        folder_bso['children'] = children + [
+            b['id'] for b in bookmarks if b['id'] not in known_children]
+
+        logger.info(f'Uploading folder and {len(bookmarks)} bookmarks')
+        uploader = self.get_uploader('bookmarks')
+        try:
+            uploader.add(folder_bso)
+            for bookmark in bookmarks:
+                uploader.add(bookmark)
+            res = uploader.commit()
+        except PreconditionFailed as e:
+            logger.error(f'Bookmark upload aborted: {e}')
+            return False
+        if res['failed']:
+            logger.error(f'Bookmark upload failed: {res["failed"]}')
             return
-        batch_id = response.get('batch')
-
-        logger.info('Uploading new individual bookmarks')
-        for i, bookmark in enumerate(bookmarks):
-            logger.debug(f"POSTing record with id {bookmark['id']}")
-            params = {'batch': batch_id}
-            if i == len(bookmarks) - 1:
-                params['commit'] = 'true'
-            res = self.sync_client.post_record(
-                'bookmarks', bookmark, encrypt=True, params=params)
-
-        logger.info('Upload completed with status: ' + res)
+        self.metrics.incr('records_uploaded', len(res['success']),
+                          collection='bookmarks')
+        logger.info(f'Upload completed in {len(uploader.chunks)} requests')
         self.update_sync_file('bookmark_upsync_time', int(time.time()))
 
 
@@ -493,7 +1356,8 @@ def main():
     parser.add_argument('-u', '--user', dest='login',
                         help='Firefox Accounts login (email address).')
     parser.add_argument('command', choices=['sync', 'sync-bookmarks',
-                                            'sync-history', 'noop'])
+                                            'sync-history', 'sync-all',
+                                            'daemon', 'noop'])
     parser.add_argument('--token-ttl', dest='token_ttl', type=int,
                         default=3600,
                         help='The validity of the OAuth token in seconds')
@@ -505,15 +1369,76 @@ def main():
     parser.add_argument('--bookmark-folder-parent',
                         dest='bookmark_folder_parent',
                         nargs=2, metavar=('ID', 'NAME'))
+    parser.add_argument('--full-sync', dest='full_sync', action='store_true',
+                        help='Ignore stored sync timestamps and fetch whole '
+                        'collections from the server')
+    parser.add_argument('--debounce', type=float, default=5,
+                        help='daemon: seconds to wait for local changes to '
+                        'settle before syncing them')
+    parser.add_argument('--poll-interval', dest='poll_interval', type=float,
+                        default=300,
+                        help='daemon: seconds between checks for remote '
+                        'changes')
+    parser.add_argument('--ignore-backoff', dest='ignore_backoff',
+                        action='store_true',
+                        help='Sync even if the server asked to back off')
     parser.add_argument('--send-qute-commands', type=bool, default=False,
                         help='Before/after syncing files, send commands to' +
                         'qutebrowser to update them')
+    parser.add_argument('--metrics-file', dest='metrics_file', type=Path,
+                        help='Write phase timings and counters to this '
+                        'file, in the Prometheus text format if it ends in '
+                        '.prom and as JSON otherwise')
+    parser.add_argument('--profile', type=Path,
+                        help='Dump cProfile stats of the run (main thread '
+                        'only) to this file')
 
     args, extra = parser.parse_known_args()
 
+    metrics = Metrics()
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run_command(args, metrics)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        logger.debug('Time spent: ' + metrics.summary())
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+
+
+def run_command(args, metrics):
+    backoff = BackoffWindow(BACKOFF_FILE)
+    remaining = backoff.remaining()
+    if remaining and not args.ignore_backoff and args.command != 'noop':
+        metrics.set('backoff_remaining_seconds', remaining)
+        if args.command != 'daemon':
+            logger.info(f'Server asked to back off ({backoff.reason()}), '
+                        f'not syncing for another {remaining:.0f}s')
+            return
+        logger.info(f'Server asked to back off, waiting {remaining:.0f}s')
+        time.sleep(remaining)
+
     qutefox = QuteFoxClient(args.login, args.client_id,
                             token_ttl=args.token_ttl,
-                            send_qute_commands=args.send_qute_commands)
+                            send_qute_commands=args.send_qute_commands,
+                            metrics=metrics)
+
+    upload_bookmark_args = {}
+    if args.bookmark_folder_name:
+        upload_bookmark_args['folder_name'] = args.bookmark_folder_name
+    if args.bookmark_folder_parent:
+        upload_bookmark_args['parent'] = {
+            'id': args.bookmark_folder_parent[0],
+            'name': args.bookmark_folder_parent[1]
+        }
+    download_bookmark_args = {}
+    if args.bookmark_folder_id:
+        download_bookmark_args['folder_id'] = args.bookmark_folder_id
 
     if args.command == 'sync':
         if args.one_way_dest is None or args.one_way_dest == 'qutebrowser':
@@ -521,22 +1446,30 @@ def main():
         if args.one_way_dest is None or args.one_way_dest == 'firefox':
             qutefox.update_ff_session()
     if args.command == 'sync-bookmarks':
-        upload_bookmark_args = {}
-        if args.bookmark_folder_name:
-            upload_bookmark_args['folder_name'] = args.bookmark_folder_name
-        if args.bookmark_folder_parent:
-            upload_bookmark_args['parent'] = {
-                'id': args.bookmark_folder_parent[0],
-                'name': args.bookmark_folder_parent[1]
-            }
-        download_bookmark_args = {}
-        if args.bookmark_folder_id:
-            download_bookmark_args['folder_id'] = args.bookmark_folder_id
         # qutefox.upload_qute_bookmarks(**upload_bookmark_args)
         qutefox.download_ff_bookmarks(**download_bookmark_args)
     if args.command == 'sync-history':
-        # qutefox.download_ff_history()
-        qutefox.upload_qute_history()
+        # like sync-all, download first so that the visits imported from
+        # Firefox are known not to need uploading
+        if args.one_way_dest is None or args.one_way_dest == 'qutebrowser':
+            qutefox.download_ff_history(force=args.full_sync)
+        if args.one_way_dest is None or args.one_way_dest == 'firefox':
+            qutefox.upload_qute_history()
+    if args.command == 'sync-all':
+        qutefox.sync_all(one_way_dest=args.one_way_dest,
+                         upload_bookmark_args=upload_bookmark_args,
+                         download_bookmark_args=download_bookmark_args,
+                         force=args.full_sync)
+    if args.command == 'daemon':
+        def after_sync():
+            if args.metrics_file:
+                metrics.write(args.metrics_file)
+
+        SyncDaemon(qutefox, QUTEBROSER_DATA_DIR, QUTEBROSER_CONFIG_DIR,
+                   debounce=args.debounce, poll_interval=args.poll_interval,
+                   upload_bookmark_args=upload_bookmark_args,
+                   download_bookmark_args=download_bookmark_args,
+                   after_sync=after_sync).run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,194 @@
+import contextlib
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('qutefox')
+
+# connections kept open per host; sync-all talks to the storage server from
+# three threads at once
+POOL_MAXSIZE = 10
+# seconds to wait for the server to accept a connection or send data
+TIMEOUT = 60
+
+
+class PooledSession(requests.Session):
+    """Session that counts the bytes its responses took on the wire."""
+
+    def __init__(self, transport):
+        super().__init__()
+        self.transport = transport
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.adapter = adapter
+        # requests asks for gzip by default, make sure it stays that way
+        if 'gzip' not in self.headers.get('Accept-Encoding', ''):
+            self.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.headers['Connection'] = 'keep-alive'
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', TIMEOUT)
+        scheduler = self.transport.scheduler
+        attempt = 0
+        while True:
+            # retries go through request() so that hawk signs them anew
+            response = super().request(method, url, **kwargs)
+            if scheduler is None:
+                return response
+            delay = scheduler.retry_delay(response, attempt)
+            if delay is None:
+                return response
+            logger.warning(f'{response.status_code} from {urlsplit(url).path}'
+                           f', retrying in {delay:.1f}s')
+            self.transport.count_retry(response)
+            time.sleep(delay)
+            attempt += 1
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        if not kwargs.get('stream'):
+            # the body has been read: tell() is what came over the wire,
+            # content is what it decoded to
+            tell = getattr(response.raw, 'tell', None)
+            body_bytes = len(response.content)
+            self.transport.count(response, tell() if tell else body_bytes,
+                                 body_bytes)
+        self.transport.capture_response(response)
+        return response
+
+    def pool_stats(self):
+        """Return (requests, connections) over this session's pools."""
+        total_requests = connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            total_requests += pool.num_requests
+            connections += pool.num_connections
+        return total_requests, connections
+
+
+class Transport():
+    """
+    One keep-alive, pooled requests.Session per host, shared by every HTTP
+    client of a QuteFoxClient: syncclient (storage and tokenserver) and the
+    FxA API client.
+
+    If a backoff.RequestScheduler is given, requests the server is too busy
+    for are retried as it decides.
+    """
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self.stats = {}
+        self.retries = {}
+        self.captures = []
+
+    def session(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self.sessions:
+                logger.debug(f'Opening connection pool for {host}')
+                self.sessions[host] = PooledSession(self)
+            return self.sessions[host]
+
+    def request(self, method, url, **kwargs):
+        """Drop-in replacement for requests.request."""
+        return self.session(url).request(method, url, **kwargs)
+
+    def install(self, module):
+        """
+        Make `module`, which calls the functions of the requests module
+        (like syncclient.client does), go through the pooled sessions.
+        """
+        module.requests = _RequestsShim(self)
+
+    def adopt(self, api_client):
+        """Give a PyFxA APIClient the pooled session of its server."""
+        api_client._session = self.session(api_client.server_url)
+
+    @contextlib.contextmanager
+    def capture(self, path):
+        """
+        Collect in the list yielded the responses, made while in the block,
+        to the requests whose URL path ends with `path`.
+        """
+        responses = []
+        capture = (path, responses)
+        with self._lock:
+            self.captures.append(capture)
+        try:
+            yield responses
+        finally:
+            with self._lock:
+                self.captures.remove(capture)
+
+    def capture_response(self, response):
+        path = urlsplit(response.url).path
+        with self._lock:
+            for suffix, responses in self.captures:
+                if path.endswith(suffix):
+                    responses.append(response)
+
+    def count(self, response, wire_bytes, body_bytes):
+        host = urlsplit(response.url).netloc
+        with self._lock:
+            stats = self.stats.setdefault(host, [0, 0])
+            stats[0] += wire_bytes
+            stats[1] += body_bytes
+
+    def count_retry(self, response):
+        host = urlsplit(response.url).netloc
+        with self._lock:
+            self.retries[host] = self.retries.get(host, 0) + 1
+
+    def collect(self, metrics):
+        """Store the counters of this transport in `metrics`."""
+        with self._lock:
+            sessions = dict(self.sessions)
+            stats = {host: list(s) for host, s in self.stats.items()}
+            retries = dict(self.retries)
+        for host, session in sessions.items():
+            total_requests, connections = session.pool_stats()
+            metrics.set('http_connections_opened', connections, host=host)
+            metrics.set('http_connections_reused',
+                        max(total_requests - connections, 0), host=host)
+        for host, (wire_bytes, body_bytes) in stats.items():
+            metrics.set('http_response_wire_bytes', wire_bytes, host=host)
+            metrics.set('http_response_body_bytes', body_bytes, host=host)
+        for host, count in retries.items():
+            metrics.set('http_retries', count, host=host)
+        if self.scheduler is not None and self.scheduler.window is not None:
+            metrics.set('backoff_remaining_seconds',
+                        self.scheduler.window.remaining())
+
+
+class _RequestsShim():
+    """The requests module, with its request functions made pooled."""
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def request(self, method, url, **kwargs):
+        return self._transport.request(method, url, **kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('GET', url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
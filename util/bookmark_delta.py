@@ -0,0 +1,14 @@
+# this file is to be called with
+# :debug-pyeval --file FILENAME
+# within qutebrowser, after QuteFoxClient.reload_qutebrowser_bookmarks
+# prepended the `delta` and `full_reload` variables to it
+bm = objreg.get('bookmark-manager')
+try:
+    for url in delta['removed']:
+        bm.marks.pop(url, None)
+    for url, title in delta['added']:
+        bm.marks[url] = title
+except Exception:
+    # the bookmark manager changed, fall back to reparsing the whole file
+    with open(full_reload) as f:
+        exec(f.read())